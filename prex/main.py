@@ -4,28 +4,11 @@ import logging
 import yaml
 import logging.config
 from pathlib import Path
-from prex.middleware import (
-    query_to_nfa,
-)
-from prex import (
-    middleware,
-)
-from prex.middleware import (
-    optimized_nfa_to_pda,
-)
 from prex.pushdown.variant import moped
-from prex.mpls.juniper.xml import (
-    juniper as new_jp,
-    model as juniper_model,
-)
-from prex.mpls.nester import Nester
 from prex.prnml import (
     xml as x,
 )
-from prex.pushdown import (
-    operations,
-    expression,
-)
+from prex.session import Session
 import timeit
 from types import (
     SimpleNamespace,
@@ -36,12 +19,17 @@ import pathlib
 
 
 logger = logging.getLogger(__name__)
-chain = []
 
 
 @click.group(invoke_without_command=True)
 @click.option('-c', '--config', default='config.yml', type=click.Path())
-def cli(config):
+@click.pass_context
+def cli(ctx, config):
+    # Subcommands queue their work in the chain, which is run on the session
+    # once the whole command line has been parsed
+    ctx.obj['chain'] = []
+    ctx.obj['session'] = Session()
+
     config_path = Path(config)
     if config_path.is_file():
         with config_path.open('rt') as f:
@@ -61,8 +49,30 @@ def cli(config):
 
 @cli.resultcallback()
 def cli_runner(_, config):
-    for op in chain:
-        op()
+    ctx = click.get_current_context()
+    with ctx.obj['session']:
+        for op in ctx.obj['chain']:
+            op()
+
+
+def cache_options(f):
+    f = click.option(
+        '--cache-dir',
+        type=click.Path(file_okay=False),
+        help='Where loaded networks are cached (default ~/.cache/prex)')(f)
+    f = click.option(
+        '--refresh-cache',
+        is_flag=True,
+        help='Load the network from its input and replace the cached copy')(f)
+    f = click.option(
+        '--cache/--no-cache',
+        default=True,
+        help='Reuse the network loaded from the same input files')(f)
+    f = click.option(
+        '--cache-fragments',
+        is_flag=True,
+        help='Also keep the pushdown fragments of routers in the cache')(f)
+    return f
 
 
 @cli.group('juniper-xml')
@@ -79,22 +89,37 @@ def cli_runner(_, config):
     '--ip-router-maps',
     multiple=True,
     type=click.Path(dir_okay=False, exists=True))
+@click.option(
+    '-j',
+    '--jobs',
+    default=1,
+    type=click.IntRange(0, None),
+    help='Number of processes parsing router files, 0 for one per core')
+@click.option(
+    '--stream/--no-stream',
+    default=False,
+    help='Read forwarding tables entry by entry, in constant memory')
+@cache_options
 @click.pass_context
-def juniper_xml(ctx, isis_dir, forwarding_dir, ip_router_maps):
+def juniper_xml(ctx, isis_dir, forwarding_dir, ip_router_maps, jobs, stream,
+                cache, refresh_cache, cache_dir, cache_fragments):
     def inner():
         t0 = timeit.default_timer()
-        ip_router_map = {}
-        for path in ip_router_maps:
-            ip_router_map.update(new_jp.parse_router_ips(path))
-        topology = new_jp.parse_isis(isis_dir)
-        parser = new_jp.ForwardingParser(topology, ip_dns_map=ip_router_map)
-        juniper_network = parser.parse_forwarding(forwarding_dir)
-        network = juniper_model.PRNMLConverter(juniper_network).convert()
-        ctx.obj['network'] = network
+        ctx.obj['session'].load_juniper(
+            isis_dir,
+            forwarding_dir,
+            ip_router_maps,
+            jobs=jobs,
+            stream=stream,
+            cache=cache,
+            refresh_cache=refresh_cache,
+            cache_dir=cache_dir,
+            cache_fragments=cache_fragments,
+        )
         t1 = timeit.default_timer()
         print(f'Loading: {t1 - t0:.3}s')
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 
 
 @cli.group()
@@ -110,16 +135,24 @@ def juniper_xml(ctx, isis_dir, forwarding_dir, ip_router_maps):
     default='./routing.xml',
     type=click.Path(exists=True)
 )
+@cache_options
 @click.pass_context
-def xml(ctx, topology, routes):
+def xml(ctx, topology, routes, cache, refresh_cache, cache_dir,
+        cache_fragments):
     def inner():
         t0 = timeit.default_timer()
-        network = x.read_network(topology, routes)
-        ctx.obj['network'] = network
+        ctx.obj['session'].load_xml(
+            topology,
+            routes,
+            cache=cache,
+            refresh_cache=refresh_cache,
+            cache_dir=cache_dir,
+            cache_fragments=cache_fragments,
+        )
         t1 = timeit.default_timer()
         print(f'Loading: {t1 - t0:.3}s')
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 
 
 @cli.group('nest-network')
@@ -139,11 +172,9 @@ def xml(ctx, topology, routes):
 @click.pass_context
 def nest_network(ctx, topology, routes, nesting_level):
     def inner():
-        nester = Nester(topology, routes)
-        network = nester.nest(nesting_level)
-        ctx.obj['network'] = network
+        ctx.obj['session'].load_nested(topology, routes, nesting_level)
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 
 
 @click.command('dump-network')
@@ -159,18 +190,18 @@ def nest_network(ctx, topology, routes, nesting_level):
     default='./routing.xml',
     type=click.Path(writable=True)
 )
+@click.option('--pretty/--compact', default=True,
+              help='Indent the written XML. Compact output is faster.')
 @click.pass_context
-def dump_network(ctx, topology, routing):
+def dump_network(ctx, topology, routing, pretty):
     def inner():
-        network = ctx.obj['network']
+        network = ctx.obj['session'].network
         with contextlib.ExitStack() as stack:
-            topology_f = stack.enter_context(open(topology, 'wt'))
-            routing_f = stack.enter_context(open(routing, 'wt'))
-            topology_str, routing_str = x.write_network(network)
-            topology_f.write(topology_str)
-            routing_f.write(routing_str)
+            topology_f = stack.enter_context(open(topology, 'wb'))
+            routing_f = stack.enter_context(open(routing, 'wb'))
+            x.stream_network(network, topology_f, routing_f, pretty)
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 xml.add_command(dump_network)  # noqa
 juniper_xml.add_command(dump_network)
 nest_network.add_command(dump_network)
@@ -179,12 +210,13 @@ nest_network.add_command(dump_network)
 @cli.command()
 @click.argument('pds-path', default='./dump.pds', type=click.Path(exists=True))
 @click.option('-v', '--verbose', count=True)
-def pds(pds_path, verbose):
+@click.pass_context
+def pds(ctx, pds_path, verbose):
     def inner():
         output = moped.runner.query_file(pds_path)
         do_output(output, verbose)
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 
 
 @click.group('adv-query')
@@ -193,14 +225,10 @@ def pds(pds_path, verbose):
 @click.pass_context
 def prex_query(ctx, query, max_failed_links):
     def inner():
-        label_domain = ctx.obj['network'].routing.collect_labels()
-
-        def parser(pda):
-            return query_to_nfa.parse_query(query, label_domain, pda)
-        ctx.obj['parser'] = parser
+        ctx.obj['query'] = query
         ctx.obj['k'] = max_failed_links
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 juniper_xml.add_command(prex_query)  # noqa
 xml.add_command(prex_query)
 
@@ -211,15 +239,10 @@ xml.add_command(prex_query)
 @click.pass_context
 def prex_file_query(ctx, query_file, max_failed_links):
     def inner():
-        qf_path = pathlib.Path(query_file)
-        label_domain = ctx.obj['network'].routing.collect_labels()
-
-        def parser(pda):
-            return query_to_nfa.parse_query(qf_path, label_domain, pda)
-        ctx.obj['parser'] = parser
+        ctx.obj['query'] = pathlib.Path(query_file)
         ctx.obj['k'] = max_failed_links
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 juniper_xml.add_command(prex_file_query)  # noqa
 xml.add_command(prex_file_query)
 
@@ -230,8 +253,8 @@ xml.add_command(prex_file_query)
 @click.pass_context
 def random_query(ctx, query_size, max_failed_links):
     def inner():
-        network = ctx.obj['network']
-        query = (
+        network = ctx.obj['session'].network
+        ctx.obj['query'] = (
             '<.*>' +
             ' .* '.join(
                 map(
@@ -244,14 +267,9 @@ def random_query(ctx, query_size, max_failed_links):
             ) +
             '<.*>'
         )
-        label_domain = ctx.obj['network'].routing.collect_labels()
-
-        def parser(pda):
-            return query_to_nfa.parse_query(query, label_domain, pda)
-        ctx.obj['parser'] = parser
         ctx.obj['k'] = max_failed_links
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 juniper_xml.add_command(random_query)  # noqa
 xml.add_command(random_query)
 
@@ -260,95 +278,40 @@ xml.add_command(random_query)
 @click.pass_context
 @click.option('-v', '--verbose', count=True)
 @click.option('--under/--over', default=False)
-def compile(ctx, under, verbose):
+@click.option('--slice/--no-slice', 'slicing', default=True,
+              help='Only simulate the routers the query can read.')
+@click.option(
+    '-j',
+    '--jobs',
+    default=1,
+    type=click.IntRange(0, None),
+    help='Number of processes building router fragments and the'
+         ' product with the query, 0 for one per core')
+def compile(ctx, under, verbose, slicing, jobs):
     def inner():
-        ctx.obj['under'] = under
         t0 = timeit.default_timer()
-        network = ctx.obj.pop('network')
-        k = ctx.obj['k']
-
-        expgen = expression.Generator()
-        ctx.obj['expgen'] = expgen
-
-        logging.info(
-            f"Processing {len(network.routing._routingTables)} routing"
-            f" tables with a total of {network.routing.count_rules()} rules"
-        )
-
-        logging.info("Constructing mpls simulation")
         print(f"Under is {under}")
-        if under:
-            mpls_fragment = middleware.underapprox.to_pushdown(
-                expgen,
-                network,
-                k=k
-            )
-        else:
-            mpls_fragment = middleware.outonly.to_pushdown(
-                expgen,
-                network,
-                k=k
-            )
-
-        logging.info(f"Constructing NFAs")
-        parser = ctx.obj.pop('parser')
-        nfa_c, nfa_n, nfa_d = parser(mpls_fragment)
-        logging.info(f"Constructing builder")
-        constructor = optimized_nfa_to_pda.ConstructingPDA(expgen, nfa_c)
-        build_fragment = constructor.convert()
-        logging.info(f"Constructing destroyer")
-        destructor = optimized_nfa_to_pda.DestructingPDA(expgen, nfa_d)
-        destroy_fragment = destructor.convert()
-
-        logging.info(
-            f"Constructing APDA from NFA ({len(nfa_n.transitions)}) and PDA"
-            f" ({len(mpls_fragment.transitions)})"
-        )
-        apda_fragment = middleware.apda.compose(
-            mpls_fragment,
-            nfa_n
-        )
-
-        logging.info(
-            f"Concating the builder ({len(build_fragment.transitions)})"
-            f" with the apda ({len(apda_fragment.transitions)})"
-        )
-        with_builder = operations.concat_disjoint(
-            build_fragment,
-            apda_fragment,
-            destructive=True
+        system = ctx.obj['session'].compile(
+            ctx.obj['query'],
+            ctx.obj['k'],
+            under=under,
+            verbose=bool(verbose),
+            slicing=slicing,
+            jobs=jobs,
         )
 
-        logging.info(f"Concating the destroyer"
-                     f" ({len(destroy_fragment.transitions)}) with the"
-                     f" builder-apda ({len(with_builder.transitions)})")
-        with_destroy = operations.concat_disjoint(
-            with_builder,
-            destroy_fragment,
-            destructive=True
-        )
-
-        logger.info(f"Compiling pushdown with {len(with_destroy.transitions)}"
-                    f" symbolic transitions")
-        system = moped.compiler.compile(
-            expgen,
-            with_destroy,
-            with_destroy.specials["start"],
-            with_destroy.specials["end"],
-            bool(verbose),
-        )
-
-        ctx.obj['system'] = system
-
         t1 = timeit.default_timer()
 
         print(f"Compiling: {t1 - t0:.3f}s")
         print(f"Size: {system.size}")
+        for name, (before, after) in ctx.obj['session'].nfa_sizes.items():
+            print(f"NFA {name}: {before[0]} locations, {before[1]}"
+                  f" transitions simplified to {after[0]} and {after[1]}")
 
         rate = system.size / (t1 - t0)
         print(f"Transitions/s: {rate:.3f} t/s")
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 prex_query.add_command(compile)  # noqa
 prex_file_query.add_command(compile)
 random_query.add_command(compile)
@@ -360,12 +323,12 @@ random_query.add_command(compile)
 @click.pass_context
 def dump_pds(ctx, dump_path):
     def inner():
-        system = ctx.obj['system']
+        system = ctx.obj['session'].system
 
         with open(dump_path, "wt") as f:
             f.write(system.str)
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 
 
 @compile.command()
@@ -376,54 +339,24 @@ def run(ctx, enable_cd, verbose):
     def inner():
         t0 = timeit.default_timer()
 
-        under = ctx.obj['under']
-        system = ctx.obj['system']
-        moped_result, transitions = moped.runner.query_system(system)
+        session = ctx.obj['session']
+        result = session.verify(cycle_detection=enable_cd)
 
         t1 = timeit.default_timer()
         print(f'Verifying: {t1 - t0:.3f}s')
 
-        rate = system.size / (t1 - t0)
+        rate = session.system.size / (t1 - t0)
         print(f"Transitions/s: {rate:.3f} t/s")
 
-        result = False
-        # If we're running the under approximation
-        # we need to ensure the witness is acyclic
-        if enable_cd and under and moped_result:
-            # Filter out internal transitions going to internal locations
-            network_transitions = (
-                transition for transition in transitions
-                if isinstance(transition.to.name, tuple)
-                and isinstance(transition.to.name[0].name, tuple)
-            )
-            routers = set()
-            previous_router_in = None
-            for transition in network_transitions:
-                router_in = tuple(transition.to.name[0].name[0:2])
-                if router_in == previous_router_in:
-                    # Need to allow traversing action chains
-                    continue
-                if router_in[0] in routers:
-                    # Found a repeated router, trace is cyclic
-                    break
-                else:
-                    previous_router_in = router_in
-                    routers.add(router_in[0])
-            else:
-                # Loop terminated normally, no duplicate routers found in trace
-                result = True
-        else:
-            result = moped_result
-
         if result:
             print('YES')
             printer = TransitionPrinter()
-            for transition in transitions:
+            for transition in result.transitions:
                 print(transition.visit(printer))
         else:
             print('NO')
 
-    chain.append(inner)
+    ctx.obj['chain'].append(inner)
 
 
 class TransitionPrinter():
@@ -2,46 +2,14 @@ from ..pushdown import (
     graph,
 )
 from ..nfa import graph as nfagraph
-from . import builder as b
+from array import array
+from collections import defaultdict
+from concurrent import futures
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
-locations = {}
-
-
-class ReplicateActionVisitor(object):
-    def __init__(self, builder):
-        self.builder = builder
-
-    def visit_noop(self, action):
-        return graph.NoopAction()
-
-    def visit_pop(self, action):
-        return graph.PopAction()
-
-    def visit_push(self, action):
-        label = self.builder.symbol(action.label.value)
-        return graph.PushAction(label)
-
-    def visit_replace(self, action):
-        label = self.builder.symbol(action.label.value)
-        return graph.ReplaceAction(label)
-
-    def visit_pushreplace(self, action):
-        label1 = self.builder.symbol(action.label1.value)
-        label2 = self.builder.symbol(action.label2.value)
-        return graph.PushReplaceAction(label1, label2)
-
-
-def _get_node_raw(builder, string):
-    return builder.location(string)
-
-
-def _get_node_compose(builder, pdaloc, nfaloc):
-    key = (pdaloc, nfaloc)
-    return builder.location(key)
-
 
 class PushdownTransitionCollector(object):
     def __init__(self):
@@ -71,81 +39,164 @@ class PushdownTransitionCollector(object):
         return transition.to
 
 
-def compose(pushdown, nfa):
-    logger.info("Split nfa transitions into epsilon/non-epsilon")
-    nfa_epsilon = []
-    nfa_non_epsilon = []
+# State of a worker process, set up once by `_init_worker`
+_worker = None
+
+
+def _init_worker(*state):
+    global _worker
+    _worker = state
+
+
+def _emit(pairs, offsets, by_source, targets, moves, product, width, chunk):
+    # The pushdown transitions leaving the reached pairs in `chunk`, as the
+    # transition ids and the product locations they go between
+    ids = array('i')
+    sources = array('i')
+    ends = array('i')
+    for from_ in range(*chunk):
+        pdaloc, nfaloc = pairs[from_]
+        nfa_moves = moves[nfaloc]
+        if not nfa_moves:
+            continue
+        for transition in by_source[offsets[pdaloc]:offsets[pdaloc + 1]]:
+            to = targets[transition]
+            for nfa_to in nfa_moves.get(to, ()):
+                ids.append(transition)
+                sources.append(from_)
+                ends.append(product[to * width + nfa_to])
+    return ids, sources, ends
+
+
+def _emit_in_worker(chunk):
+    return tuple(rows.tobytes() for rows in _emit(*_worker, chunk))
+
+
+def _emit_all(state, chunks, jobs):
+    """Emit the rows of all `chunks`, in a process pool if `jobs` > 1."""
+    if jobs == 1 or len(chunks) <= 1:
+        return [_emit(*state, chunk) for chunk in chunks]
+    with futures.ProcessPoolExecutor(max_workers=jobs,
+                                     initializer=_init_worker,
+                                     initargs=state) as executor:
+        return [
+            tuple(array('i', rows) for rows in result)
+            for result in executor.map(_emit_in_worker, chunks)
+        ]
+
+
+def compose(expgen, pushdown, nfa, jobs=1):
+    """Build the product of `pushdown` and the network NFA reading it.
+
+    The NFA reads the location the pushdown moves to with each transition.
+    Only the pairs of locations reachable from the start are built, found
+    by a breadth first search. Pairs are keyed by an integer while building,
+    the locations of the product are named by the pair itself.
+
+    The search numbers the pairs, after which the transitions out of them
+    are emitted by `jobs` processes, 0 for one per core, each for a range of
+    the pairs. The ranges are put back together in order, so the product is
+    the same for any number of processes.
+    """
+    if jobs is None or jobs == 0:
+        jobs = os.cpu_count()
+
+    nfa_locations = list(nfa.locations)
+    nfa_ids = {location: i for i, location in enumerate(nfa_locations)}
+    width = len(nfa_locations)
+
+    # By NFA location, the NFA locations reached by reading a pushdown
+    # location, and those reached by epsilon transitions
+    moves = [defaultdict(list) for _ in nfa_locations]
+    epsilons = [[] for _ in nfa_locations]
     for transition in nfa.transitions:
+        from_ = nfa_ids[transition.from_]
+        to = nfa_ids[transition.to]
         if isinstance(transition, nfagraph.EpsilonTransition):
-            nfa_epsilon.append(transition)
+            epsilons[from_].append(to)
         else:
-            nfa_non_epsilon.append(transition)
-
-    pda = graph.PDA()
-    builder = b.PDABuilder(pda)
+            moves[from_][transition.symbol.value.id].append(to)
+    moves = [dict(nfa_moves) for nfa_moves in moves]
 
     newPDAStart = pushdown.location("apda_start")
-    startNode = _get_node_compose(builder, newPDAStart, nfa.initial)
-    pda.start_location(startNode)
-
-    logger.info("Start transitions")
-    for transition in nfa_non_epsilon:
-
-        if transition.symbol.value != pushdown.initial:
+    offsets, by_source = pushdown.outgoing_index()
+    targets = pushdown.targets
+
+    # dict: pushdown location id * width + nfa location id -> index of the
+    # pair in `pairs`, which is the location id in the product
+    product = {}
+    pairs = []
+
+    def locate(pdaloc, nfaloc):
+        key = pdaloc * width + nfaloc
+        location = product.get(key)
+        if location is None:
+            location = product[key] = len(pairs)
+            pairs.append((pdaloc, nfaloc))
+        return location
+
+    logger.info("Searching the reachable product")
+    startNode = locate(newPDAStart.id, nfa_ids[nfa.initial])
+    initial = pushdown.initial.id
+    start_targets = [
+        locate(initial, to)
+        for nfaloc in range(width)
+        for to in moves[nfaloc].get(initial, ())
+    ]
+    # The start location has no transitions of the pushdown
+    searched = 1
+    while searched < len(pairs):
+        pdaloc, nfaloc = pairs[searched]
+        searched += 1
+        for to in epsilons[nfaloc]:
+            locate(pdaloc, to)
+        nfa_moves = moves[nfaloc]
+        if not nfa_moves:
             continue
+        for transition in by_source[offsets[pdaloc]:offsets[pdaloc + 1]]:
+            to = targets[transition]
+            for nfa_to in nfa_moves.get(to, ()):
+                locate(to, nfa_to)
+    finalNode = locate(pushdown.final.id, nfa_ids[nfa.final])
 
-        exitNode = _get_node_compose(builder, pushdown.initial, transition.to)
+    pda = graph.PDA()
+    for pdaloc, nfaloc in pairs:
+        pda.location((pushdown.location_view(pdaloc), nfa_locations[nfaloc]))
+    pda.start_location(pda.location_view(startNode))
+    pda.end_location(pda.location_view(finalNode))
 
+    for to in start_targets:
         pda.star_transition(
-            startNode, exitNode,
+            pda.location_view(startNode),
+            pda.location_view(to),
             graph.NoopAction(),
         ).attach()
 
-    logger.info("Epsilon loops")
-    for transition in nfa_epsilon:
-        for location in pushdown.locations:
-
-            enterNode = _get_node_compose(builder, location, transition.from_)
-            exitNode = _get_node_compose(builder, location, transition.to)
-
+    # Only moves in the NFA, so all variables are kept
+    keep = graph.Guard(expgen.get_expression())
+    for from_, (pdaloc, nfaloc) in enumerate(pairs):
+        # The start location only has its start transitions, which already
+        # leave from any NFA location, so its epsilons were never searched
+        if from_ == startNode:
+            continue
+        for to in epsilons[nfaloc]:
             pda.star_transition(
-                enterNode, exitNode,
-                graph.NoopAction()
+                pda.location_view(from_),
+                pda.location_view(product[pdaloc * width + to]),
+                graph.NoopAction(),
+                guard=keep,
             ).attach()
 
-    replicateVisitor = ReplicateActionVisitor(builder)
-
-    logger.info(f"Cross product (nfa tranitions: {len(nfa_non_epsilon)})")
-    for nfaTrans in nfa_non_epsilon:
-        for pdaTrans in nfaTrans.symbol.value._incoming:
-            enterNode = _get_node_compose(builder, pdaTrans.from_,
-                                          nfaTrans.from_)
-            exitNode = _get_node_compose(builder, pdaTrans.to, nfaTrans.to)
-
-            if isinstance(pdaTrans, graph.StarTransition):
-                action = pdaTrans.action.visit(replicateVisitor)
-                pda.star_transition(
-                    enterNode, exitNode,
-                    action,
-                    pdaTrans.text,
-                    pdaTrans.guard,
-                ).attach()
-            elif isinstance(pdaTrans, graph.Transition):
-                symbol = builder.symbol(pdaTrans.inlabel.value)
-                action = pdaTrans.action.visit(replicateVisitor)
-                pda.transition(
-                    enterNode, exitNode,
-                    symbol,
-                    action,
-                    pdaTrans.text,
-                    pdaTrans.guard,
-                ).attach()
-            else:
-                raise RuntimeError(f"Unkonwn transition type {pdaTrans}")
-
-    finalNode = _get_node_compose(builder, pushdown.final, nfa.final)
-    pda.end_location(finalNode)
-
-    logging.info(f"Complete (size: {len(pda.transitions)})")
+    logger.info(f"Emitting the transitions of {len(pairs)} of"
+                f" {len(pushdown.location_names) * width} location pairs")
+    step = -(-len(pairs) // jobs)
+    chunks = [(start, min(start + step, len(pairs)))
+              for start in range(0, len(pairs), step)]
+    state = (pairs, offsets, by_source, targets, moves, product, width)
+    # Labels and actions are shared, so they are used as they are
+    for ids, sources, ends in _emit_all(state, chunks, jobs):
+        pda.copy_transitions(pushdown, ids, sources, ends)
+
+    logger.info(f"Complete (size: {len(pda.transitions)})")
 
     return pda
@@ -13,7 +13,7 @@ class PDABuilder(object):
         self.pda = pda
 
         self.symbols = {symbol.value: symbol for symbol in pda.symbols}
-        self.locations = {location.value: location for location in
+        self.locations = {location.name: location for location in
                           pda.locations}
 
     def symbol(self, value):
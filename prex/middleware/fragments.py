@@ -0,0 +1,356 @@
+"""Pushdown fragments of single routers, reused between compilations.
+
+The mpls simulation is put together from one fragment per router: the action
+chains of its rules, the transitions into them from the start location and over
+its links, and its transitions to the end location. Each fragment is described
+by a recipe, a tuple of everything that goes into it, and as long as the recipe
+of a router stays the same its fragment is reused as it is. After a change to
+a few routing tables only the fragments of those routers, and of routers whose
+links carry different labels now, are built again.
+
+The over- and under-approximation only differ in their recipes and in the
+guards into the chains of rules, `build` turns the recipes of both into
+fragments.
+
+Fragments are keyed by a digest of their recipe, in which routers, interfaces
+and labels are pickled by their names. A recipe is thus the same for the next
+snapshot of a network as long as the router's rules and links are. Reused for
+another network, a fragment is pickled the same way and read back with the
+objects of that network. With a `NetworkCache` as store, fragments are also
+kept on disk for later runs.
+
+Fragments can be built by a pool of processes, which send them back pickled
+by name as well.
+"""
+from collections import (
+    defaultdict,
+    namedtuple,
+)
+from concurrent import futures
+import hashlib
+import io
+import logging
+import os
+import pickle
+
+from ..prnml import model
+from ..pushdown import graph
+from . import builder as b
+from . import fusion
+
+
+logger = logging.getLogger(__name__)
+
+
+# Bump whenever fragments are built differently, so stored ones aren't reused
+FRAGMENT_VERSION = 1
+
+
+# Recipe entries. A rule is taken into the fragment as its label, egress and
+# actions, since rules can change in place.
+# From the start location into the chain of a rule
+Start = namedtuple('Start', ['label', 'to', 'actions', 'failures'])
+# From the outface of `side` over a link into the chain of a rule
+Through = namedtuple('Through', ['side', 'label', 'to', 'actions', 'from_',
+                                 'failures'])
+# From the outface of an interface to the end location
+End = namedtuple('End', ['interface'])
+
+
+def link_sides(network, slice_=None):
+    """Map every router to the pairs of sides its links enter it through.
+
+    A pair is the side a packet leaves through and the side of the router it
+    arrives at, in the order of the links.
+    """
+    sides = defaultdict(list)
+    for link in network.topology.links:
+        if slice_ is not None and not (link.from_.router in slice_.routers
+                                       and link.to.router in slice_.routers):
+            continue
+        sides[link.to.router].append((link.from_, link.to))
+        sides[link.from_.router].append((link.to, link.from_))
+    return sides
+
+
+def ingresses(router):
+    """The interfaces of `router` rules can match on."""
+    # Wildcard rules are only visited once, not once per interface
+    yield from router.interfaces.values()
+    yield model.ANY_INTERFACE
+
+
+def _get_node_raw(builder, string):
+    return builder.location(string)
+
+
+def _get_node_outface(builder, switch, interface, ops):
+    return builder.location((switch, interface, ops))
+
+
+def build_action_chain(expgen, builder, switch, interface, ops):
+    """Build the transitions doing `ops` before leaving through `interface`,
+    returning the location they start from."""
+    # The builder only has a location for a chain once it has been built
+    key = (switch, interface, ops)
+    if key in builder.locations:
+        return builder.locations[key]
+
+    enterNode = _get_node_outface(builder, switch, interface, ops)
+
+    if ops is ():
+        return enterNode
+
+    # As many operations as possible are done by one transition
+    action, ops = fusion.first_step(ops, builder.symbol)
+    exitNode = build_action_chain(
+        expgen,
+        builder,
+        switch,
+        interface,
+        ops
+    )
+
+    builder.pda.star_transition(
+        enterNode, exitNode,
+        action,
+        guard=graph.Guard(expgen.get_expression())
+    ).attach()
+    return enterNode
+
+
+def build(expgen, start_guard, through_guard, router, recipe):
+    """Build the fragment of `router` from its recipe.
+
+    `start_guard` and `through_guard` give the guard of the transition into
+    the chain of a `Start` or `Through` entry from the entry's failures, with
+    None they are left unguarded.
+    """
+    pda = graph.PDA()
+    builder = b.PDABuilder(pda)
+
+    for entry in recipe:
+        if isinstance(entry, End):
+            pda.star_transition(
+                _get_node_outface(builder, router, entry.interface, ()),
+                _get_node_raw(builder, "simend"),
+                graph.NoopAction(),
+            ).attach()
+            continue
+
+        label = builder.symbol(entry.label)
+        exitNode = build_action_chain(
+            expgen,
+            builder,
+            router,
+            entry.to,
+            entry.actions,
+        )
+        if isinstance(entry, Start):
+            # Connect the chain to the actual exitNode
+            pda.transition(
+                _get_node_raw(builder, "simstart"), exitNode,
+                label,
+                graph.NoopAction(),
+                guard=(graph.Guard() if start_guard is None
+                       else start_guard(entry.failures)),
+            ).add_comment("To start the simulation").attach()
+        else:
+            enterNode = _get_node_outface(
+                builder,
+                entry.side.router,
+                entry.side.interface,
+                (),
+            )
+            pda.transition(
+                enterNode, exitNode,
+                label,
+                graph.NoopAction(),
+                guard=(graph.Guard() if through_guard is None
+                       else through_guard(entry.failures)),
+            ).add_comment(f"Through {entry.from_}").attach()
+
+    return pda
+
+
+def object_names(network):
+    """Name the objects of `network` fragments refer to.
+
+    Returns a dict from the id of each object to its name, and one from the
+    name back to the object.
+    """
+    objects = {('any', ): model.ANY_INTERFACE}
+    for router in network.topology.routers:
+        objects['router', router.name] = router
+        for interface in router.interfaces.values():
+            objects['interface', router.name, interface.name] = interface
+    for label in network.routing.collect_labels():
+        objects['label', label.name] = label
+    return ({id(obj): name for name, obj in objects.items()}, objects)
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, ids):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.ids = ids
+
+    def persistent_id(self, obj):
+        return self.ids.get(id(obj))
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, objects):
+        super().__init__(file)
+        self.objects = objects
+
+    def persistent_load(self, pid):
+        return self.objects[pid]
+
+
+def _dumps(obj, ids):
+    buffer = io.BytesIO()
+    _Pickler(buffer, ids).dump(obj)
+    return buffer.getvalue()
+
+
+def _loads(data, objects):
+    return _Unpickler(io.BytesIO(data), objects).load()
+
+
+def _digest(kind, context, router, recipe, ids):
+    digest = hashlib.sha256()
+    digest.update(pickle.dumps((FRAGMENT_VERSION, kind, context),
+                               protocol=pickle.HIGHEST_PROTOCOL))
+    digest.update(_dumps((router, recipe), ids))
+    return digest.hexdigest()
+
+
+# State of a worker process, set up once by `_init_worker`
+_worker = None
+
+
+def _init_worker(build, routers, recipes, network):
+    global _worker
+    _worker = (build, routers, recipes, object_names(network)[0])
+
+
+def _build_in_worker(index):
+    build, routers, recipes, ids = _worker
+    return _dumps(build(routers[index], recipes[index]), ids)
+
+
+def _build_all(build, routers, recipes, network, jobs):
+    """Build the fragments of `routers`, in a process pool if `jobs` > 1.
+
+    Returns pairs of a fragment and its pickle, None for those built in this
+    process.
+    """
+    if jobs is None or jobs == 0:
+        jobs = os.cpu_count()
+    if jobs == 1 or len(routers) <= 1:
+        return [(build(router, recipe), None)
+                for router, recipe in zip(routers, recipes)]
+
+    objects = object_names(network)[1]
+    with futures.ProcessPoolExecutor(
+            max_workers=min(jobs, len(routers)),
+            initializer=_init_worker,
+            initargs=(build, routers, recipes, network)) as executor:
+        return [
+            (_loads(data, objects), data)
+            for data in executor.map(_build_in_worker, range(len(routers)))
+        ]
+
+
+class FragmentCache(object):
+    def __init__(self, store=None):
+        # dict: kind -> (objects, dict: digest -> fragment), the fragments
+        # refer to the objects `object_names` found in their network
+        self._fragments = {}
+        # A `NetworkCache` fragments are also kept in, if any
+        self.store = store
+
+    def clear(self):
+        self._fragments.clear()
+
+    def _stored(self, digest, objects):
+        # The fragment from the store, if it can be read
+        if self.store is None:
+            return None
+        data = self.store.read(f'{digest}.fragment')
+        if data is None:
+            return None
+        try:
+            return _loads(data, objects)
+        except (pickle.UnpicklingError, EOFError, AttributeError, KeyError,
+                ImportError, TypeError, ValueError) as e:
+            logger.warning(f'Ignoring unreadable fragment {digest}: {e}')
+            return None
+
+    def assemble(self, kind, context, network, recipe, build, jobs=1):
+        """Assemble the pushdown of the routers of `network`.
+
+        `recipe(router)` describes the fragment of a router, which
+        `build(router, recipe)` turns into a PDA sharing the locations
+        "simstart" and "simend" by name. Fragments of an earlier call with the
+        same `kind` and `context` are reused for recipes with the same value,
+        those of routers not in the network any more are dropped. With `jobs`
+        other than 1 the remaining fragments are built by that many processes,
+        0 for one per core, for which `build` has to be picklable.
+        """
+        ids, objects = object_names(network)
+        previous_objects, previous = self._fragments.get(kind, (objects, {}))
+        # Fragments of another network are moved over to this one by name
+        previous_ids = None
+        if (previous_objects.keys() != objects.keys()
+                or any(previous_objects[name] is not obj
+                       for name, obj in objects.items())):
+            previous_ids = {id(obj): name
+                            for name, obj in previous_objects.items()}
+
+        digests = {}
+        fragments = {}
+        stored = 0
+        missing = []
+        recipes = []
+        for router in network.topology.routers:
+            router_recipe = recipe(router)
+            digest = digests[router] = _digest(kind, context, router,
+                                               router_recipe, ids)
+            fragment = previous.get(digest)
+            if fragment is not None and previous_ids is not None:
+                fragment = _loads(_dumps(fragment, previous_ids), objects)
+            if fragment is None:
+                fragment = self._stored(digest, objects)
+                stored += fragment is not None
+            if fragment is None:
+                missing.append(router)
+                recipes.append(router_recipe)
+            fragments[router] = fragment
+        logger.info(f"Reusing {len(digests) - len(missing)} of"
+                    f" {len(digests)} router fragments, {stored} of them"
+                    f" stored")
+
+        built = _build_all(build, missing, recipes, network, jobs)
+        for router, (fragment, data) in zip(missing, built):
+            fragments[router] = fragment
+            if self.store is not None:
+                if data is None:
+                    data = _dumps(fragment, ids)
+                self.store.write(f'{digests[router]}.fragment', data)
+        self._fragments[kind] = (objects, {
+            digests[router]: fragment
+            for router, fragment in fragments.items()
+        })
+
+        # Merged in the order of the routers, however they were built
+        pda = graph.PDA()
+        builder = b.PDABuilder(pda)
+        start = builder.location("simstart")
+        end = builder.location("simend")
+        for fragment in fragments.values():
+            pda.merge(fragment, builder.location)
+
+        pda.start_location(start)
+        pda.end_location(end)
+        return pda
@@ -0,0 +1,67 @@
+"""Fusion of the MPLS operations of a rule into pushdown actions.
+
+A pushdown rule reads the top of the stack and writes up to two labels in its
+place, so a run of operations that never looks below the label it started on
+and leaves at most two labels can be done by a single rule, e.g. a swap
+followed by a push is one `PushReplaceAction`.
+
+Operations after a pop that emptied the part of the stack seen so far are not
+fused: they act on a label below, which might be the bottom of the stack, and
+on their own they get stuck there.
+"""
+from ..pushdown import graph
+
+
+# The label on top of the stack before the operations
+_TOP = object()
+
+
+class _Simulator(object):
+    # Apply an operation to the labels written so far, bottom first
+
+    def visit_swapaction(self, op, stack):
+        return stack[:-1] + (op.label, )
+
+    def visit_pushaction(self, op, stack):
+        return stack + (op.label, )
+
+    def visit_popaction(self, op, stack):
+        return stack[:-1]
+
+    def visit_noopaction(self, op, stack):
+        return stack
+
+
+_simulator = _Simulator()
+
+
+def _action(stack, symbol):
+    if not stack:
+        return graph.PopAction()
+    *below, top = stack
+    if not below:
+        if top is _TOP:
+            return graph.NoopAction()
+        return graph.ReplaceAction(symbol(top))
+    below, = below
+    if below is _TOP:
+        return graph.PushAction(symbol(top))
+    return graph.PushReplaceAction(symbol(top), symbol(below))
+
+
+def first_step(ops, symbol):
+    """Fuse the longest prefix of `ops` that a single action can do.
+
+    Returns the action and the operations left after it. `symbol` maps an
+    MPLS label to the label of the pushdown.
+    """
+    stack = (_TOP, )
+    step = None
+    for i, op in enumerate(ops):
+        if not stack:
+            break
+        stack = op.visit(_simulator, stack)
+        if len(stack) <= 2:
+            step = stack, ops[i + 1:]
+    stack, ops = step
+    return _action(stack, symbol), ops
@@ -0,0 +1,168 @@
+"""Forward analysis of the labels packets can carry through the network.
+
+Starting from the labels of a query's header, a rule can only fire if its
+label can be on top of the stack, and its actions decide what can be on top
+afterwards. Below the top, the stack is abstracted by a single set of labels
+that can be in it anywhere, which pops expose together with the bottom of the
+stack.
+
+Only labels new to an interface are followed further, so every rule fires at
+most once per label and interface.
+"""
+from ..nfa import graph as nfagraph
+from ..prnml import model
+
+from collections import defaultdict
+from types import SimpleNamespace
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# On top of the stack when it is empty
+BOS = None
+# On top of the stack after a pop, any of the stacked labels or BOS
+STACKED = object()
+
+
+def _label(label):
+    if isinstance(label, model.NoLabel):
+        return BOS
+    return label
+
+
+_label_pruner = SimpleNamespace(**{
+    "visit_swapaction": lambda x, _: {_label(x.label)},
+    "visit_pushaction": lambda x, _: {_label(x.label)},
+    "visit_popaction": lambda x, _: {STACKED},
+    "visit_noopaction": lambda x, t: t,
+})
+
+
+def header_labels(nfa):
+    """Collect the labels a header accepted by `nfa` can contain."""
+    return {
+        _label(transition.symbol.value) for transition in nfa.transitions
+        if not isinstance(transition, nfagraph.EpsilonTransition)
+    }
+
+
+class LabelFlow(object):
+    def __init__(self, network, header, slice_=None):
+        self.network = network
+        self.slice = slice_
+
+        # A packet can start anywhere with any header
+        self.start_tops = set(header) | {BOS}
+        self.stacked = set(header) - {BOS}
+
+        self._other_sides = defaultdict(list)
+        for link in network.topology.links:
+            self._other_sides[link.from_.router, link.from_.interface].append(
+                link.to
+            )
+            self._other_sides[link.to.router, link.to.interface].append(
+                link.from_
+            )
+
+        # Keyed by the router and interface a packet leaves through
+        self._tops = {}
+        # Labels not yet followed out of an interface
+        self._delta = defaultdict(set)
+        # Labels stacked since the last round
+        self._new_stacked = set()
+        self._indices = {}
+
+        self._run()
+
+    def can_start(self, label):
+        """Whether a rule for `label` can fire on a packet just starting."""
+        return _label(label) in self.start_tops
+
+    def can_leave(self, router, interface, label):
+        """Whether `label` can be on top when leaving through `interface`."""
+        tops = self._tops.get((router, interface), ())
+        label = _label(label)
+        return label in tops or (
+            STACKED in tops and (label is BOS or label in self.stacked)
+        )
+
+    def _index(self, router):
+        # Destinations by ingress and normalized label
+        try:
+            return self._indices[router]
+        except KeyError:
+            pass
+        index = defaultdict(list)
+        rt = self.network.routing.get_table(router)
+        if rt is not None:
+            for (from_, label), destination in rt.destinations.items():
+                index[from_, _label(label)].append(destination)
+        self._indices[router] = index
+        return index
+
+    def _run(self):
+        for router in self.network.topology.routers:
+            if self.slice is not None and router not in self.slice.starts:
+                continue
+            rt = self.network.routing.get_table(router)
+            if rt is None:
+                continue
+            ingresses = [*router.interfaces.values(), model.ANY_INTERFACE]
+            for ingress in ingresses:
+                for destination in rt.get_destinations_from(ingress):
+                    if self.can_start(destination.label):
+                        self._fire(router, destination)
+
+        rounds = 0
+        while self._delta:
+            rounds += 1
+            while self._delta:
+                key, labels = self._delta.popitem()
+                for side in self._other_sides.get(key, ()):
+                    if (self.slice is not None
+                            and side.router not in self.slice.routers):
+                        continue
+                    index = self._index(side.router)
+                    for label in labels:
+                        for ingress in (side.interface, model.ANY_INTERFACE):
+                            for destination in index.get((ingress, label), ()):
+                                self._fire(side.router, destination)
+
+            # Pops expose the labels stacked in the meantime as well
+            new_stacked = self._new_stacked
+            self._new_stacked = set()
+            if new_stacked:
+                for key, tops in self._tops.items():
+                    if STACKED in tops:
+                        self._delta[key] |= new_stacked
+
+        logger.info(f"Labels flow out of {len(self._tops)} interfaces after"
+                    f" {rounds} rounds")
+
+    def _fire(self, router, destination):
+        for te_group in destination.te_groups:
+            for rule in te_group.rules:
+                tops = {_label(destination.label)}
+                for op in rule.actions:
+                    tops = op.visit(_label_pruner, tops)
+                    self._stack(tops)
+                self._leave((router, rule.to), tops)
+
+    def _stack(self, labels):
+        for label in labels:
+            if label is not BOS and label is not STACKED \
+                    and label not in self.stacked:
+                self.stacked.add(label)
+                self._new_stacked.add(label)
+
+    def _leave(self, key, labels):
+        tops = self._tops.setdefault(key, set())
+        new = labels - tops
+        if not new:
+            return
+        tops |= new
+        if STACKED in new:
+            new = (new - {STACKED}) | self.stacked | {BOS}
+        self._delta[key] |= new
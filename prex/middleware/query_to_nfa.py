@@ -317,7 +317,7 @@ class Network(NFAConstructor):
         return self._nfa
 
 
-def parse_query(query, label_domain, pda):
+def read_query(query):
     if isinstance(query, str):
         lexer = Lexer(io.StringIO(query))
     elif isinstance(query, io.IOBase):
@@ -328,12 +328,25 @@ def parse_query(query, label_domain, pda):
     else:
         raise RuntimeError('query must be str or IOBase')
     parser = Parser(lexer)
-    query_ast = parser.parse().getPQuery()
+    return parser.parse().getPQuery()
+
 
+def label_map(label_domain):
     name_label_map = {value.name: value for value in label_domain}
-    name_label_map = keydefaultdict(lambda x: prnml.Label(x), **name_label_map)
-    # First element of the location tuple is the router
+    return keydefaultdict(lambda x: prnml.Label(x), **name_label_map)
+
+
+def parse_constructing(query_ast, name_label_map):
+    c = Constructing(name_label_map)
+    return c.parse_ast(query_ast.getConstructing())
+
+
+def parse_network(query_ast, pda, routers=()):
+    # First element of the location tuple is the router. Routers can be
+    # named up front, in case they have no locations in a sliced pda.
     router_name_location_map = defaultdict(list)
+    for router in routers:
+        router_name_location_map[router.name]
 
     for location in pda.locations:
         if isinstance(location.name, str):
@@ -342,12 +355,21 @@ def parse_query(query, label_domain, pda):
 
     router_name_location_map = dict(router_name_location_map)
 
-    c = Constructing(name_label_map)
     n = Network(router_name_location_map, pda)
+    return n.parse_ast(query_ast.getNetwork())
+
+
+def parse_destructing(query_ast, name_label_map):
     d = Destructing(name_label_map)
+    return d.parse_ast(query_ast.getDestructing())
+
+
+def parse_query(query, label_domain, pda):
+    query_ast = read_query(query)
+    name_label_map = label_map(label_domain)
 
-    nfa_c = c.parse_ast(query_ast.getConstructing())
-    nfa_n = n.parse_ast(query_ast.getNetwork())
-    nfa_d = d.parse_ast(query_ast.getDestructing())
+    nfa_c = parse_constructing(query_ast, name_label_map)
+    nfa_n = parse_network(query_ast, pda)
+    nfa_d = parse_destructing(query_ast, name_label_map)
 
     return nfa_c, nfa_n, nfa_d
@@ -0,0 +1,126 @@
+"""Slice the network down to the routers a query can observe.
+
+Every location a trace enters has to be read by the network part of the
+query, so a trace starts at a router the query can read first, ends at a
+router it can read last, and never visits a router the query cannot read at
+all. Everything else can be left out of the pushdown.
+"""
+from collections import namedtuple
+
+from ..lang.prex import (
+    Analysis,
+    AOneOrMoreQuantifier,
+)
+from .query_to_nfa import NFAConstructor
+
+
+# The routers a (sub)query can read first, last and at all, and whether it
+# accepts the empty path
+_Routers = namedtuple('_Routers', ['first', 'last', 'any', 'nullable'])
+
+
+class Slice(object):
+    def __init__(self, starts, ends, routers):
+        self.starts = starts
+        self.ends = ends
+        self.routers = routers
+
+    def __repr__(self):
+        return (f'<Slice {len(self.starts)} starts, {len(self.ends)} ends,'
+                f' {len(self.routers)} routers>')
+
+
+class Slicer(Analysis):
+    def __init__(self, router_names):
+        super().__init__()
+        self.router_names = frozenset(router_names)
+
+    def _atom(self, names):
+        names = frozenset(names)
+        return _Routers(names, names, names, False)
+
+    def caseALiteralSymbolType(self, node):
+        return NFAConstructor.escape_expander.sub(
+            r'\1',
+            node.getWord().getText()
+        )
+
+    def caseASimpleSymbol(self, node):
+        return {node.getSymbolType().apply(self)}
+
+    def caseATupleSymbol(self, node):
+        raise NotImplementedError()
+
+    def caseASimpleAtom(self, node):
+        return self._atom(node.getSymbol().apply(self))
+
+    def caseAAnyAtom(self, node):
+        return self._atom(self.router_names)
+
+    def _set_names(self, node):
+        names = set()
+        for child in node.getSymbols():
+            names.update(child.apply(self))
+        return names
+
+    def caseAPositiveSetAtom(self, node):
+        return self._atom(self._set_names(node))
+
+    def caseANegativeSetAtom(self, node):
+        return self._atom(self.router_names - self._set_names(node))
+
+    def caseAAlternativeAtom(self, node):
+        left = node.getLeft().apply(self)
+        right = node.getRight().apply(self)
+        return _Routers(
+            left.first | right.first,
+            left.last | right.last,
+            left.any | right.any,
+            left.nullable or right.nullable,
+        )
+
+    def caseAQuantifiedAtom(self, node):
+        atom = node.getAtom().apply(self)
+        if isinstance(node.getQuantifier(), AOneOrMoreQuantifier):
+            return atom
+        return atom._replace(nullable=True)
+
+    def caseASequenceAtom(self, node):
+        atoms = [atom.apply(self) for atom in node.getAtoms()]
+
+        first = frozenset()
+        for atom in atoms:
+            first |= atom.first
+            if not atom.nullable:
+                break
+
+        last = frozenset()
+        for atom in reversed(atoms):
+            last |= atom.last
+            if not atom.nullable:
+                break
+
+        return _Routers(
+            first,
+            last,
+            frozenset().union(*(atom.any for atom in atoms)),
+            all(atom.nullable for atom in atoms),
+        )
+
+
+def slice_query(query_ast, topology):
+    """Compute the `Slice` of the topology the query's network part reads.
+
+    Returns None for a query without a network part.
+    """
+    network_ast = query_ast.getNetwork()
+    if network_ast is None:
+        return None
+
+    routers = {router.name: router for router in topology.routers}
+    names = network_ast.apply(Slicer(routers.keys()))
+
+    def lookup(names):
+        return frozenset(routers[name] for name in names if name in routers)
+
+    return Slice(lookup(names.first), lookup(names.last), lookup(names.any))
@@ -1,36 +1,14 @@
+import os
 import re
+import itertools
 import pathlib
+from concurrent import futures
+from collections import defaultdict
 from lxml import etree
+from prex.util import (
+    memoized,
+)
 from . import model
-import io
-
-
-# http://wiki.tei-c.org/index.php/Remove-Namespaces.xsl
-ns_stripper_xslt = b'''<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
-<xsl:output method="xml" indent="no"/>
-
-<xsl:template match="/|comment()|processing-instruction()">
-    <xsl:copy>
-      <xsl:apply-templates/>
-    </xsl:copy>
-</xsl:template>
-
-<xsl:template match="*">
-    <xsl:element name="{local-name()}">
-      <xsl:apply-templates select="@*|node()"/>
-    </xsl:element>
-</xsl:template>
-
-<xsl:template match="@*">
-    <xsl:attribute name="{local-name()}">
-      <xsl:value-of select="."/>
-    </xsl:attribute>
-</xsl:template>
-</xsl:stylesheet>
-'''  # noqa
-ns_stripper_doc = etree.parse(io.BytesIO(ns_stripper_xslt))
-ns_stripper = etree.XSLT(ns_stripper_doc)
-
 
 
 _parse_ip_re = re.compile(r'^.\s*(?P<ip>(?:\d{1,3}\.?){4})/\d{1,2}\s*H\s*-\s*(?P<domain>[^\s]+)')  # noqa
@@ -48,30 +26,71 @@ def parse_router_ips(router_ip_path):
     return mapping
 
 
-def parse_isis(dump_folder):
+def _dump_files(dump_folder):
+    # Sorted, so the merged model does not depend on directory order
     path = pathlib.Path(dump_folder)
-    files = [node for node in path.iterdir() if node.is_file()]
+    return sorted(node for node in path.iterdir() if node.is_file())
+
+
+def _map_files(function, files, jobs):
+    """Apply `function` to every file, yielding results in file order.
+
+    With more than one job the files are handed to a process pool, so only
+    the per-router XML work runs in parallel. The results are merged by the
+    caller in file order, which keeps the resulting model deterministic.
+    """
+    if jobs is None or jobs == 0:
+        jobs = os.cpu_count()
+    if jobs == 1 or len(files) <= 1:
+        yield from map(function, files)
+        return
+
+    with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(_collect, itertools.repeat(function), files)
+
+
+def _collect(function, file):
+    # Generators can't be sent back from the pool, so materialize them
+    return list(function(file))
+
+
+def _parse_tree(file):
+    # Juniper puts every table in its own namespace, all lookups below match
+    # on the local name with {*} instead of rewriting the document
+    parser = etree.XMLParser(remove_blank_text=True)
+    return etree.parse(str(file), parser)
+
+
+def read_isis(file):
+    """Read the adjacencies of a single ISIS dump.
+
+    Returns a list of (system name, interface name) pairs.
+    """
+    root = _parse_tree(file).getroot()
+    isis = root.find('{*}isis-adjacency-information')
+    return [
+        (
+            adjacency.find('{*}system-name').text,
+            adjacency.find('{*}interface-name').text,
+        )
+        for adjacency in isis.findall('{*}isis-adjacency')
+    ]
+
+
+def parse_isis(dump_folder, jobs=1):
+    files = _dump_files(dump_folder)
 
     topology = model.Topology(dict())
 
     # Setup links
-    for file in files:
+    for file, adjacencies in zip(files, _map_files(read_isis, files, jobs)):
         router = topology.add_or_get_router(f'{file.stem}')
-        parser = etree.XMLParser(remove_blank_text=True)
-        tree = etree.parse(str(file), parser)
-        tree = ns_stripper(tree)
-
-        root = tree.getroot()
-        isis = root.find('isis-adjacency-information')
-        for adjacency in isis.findall('isis-adjacency'):
-            system_name = adjacency.find('system-name')
-            interface_name = adjacency.find('interface-name')
-
-            outgoing_interface = router.add_interface(interface_name.text)
+        for system_name, interface_name in adjacencies:
+            outgoing_interface = router.add_interface(interface_name)
 
             # Remove routing engine suffix
             norm_system_name = (
-                re.sub(r'-re\d$', '', system_name.text)
+                re.sub(r'-re\d$', '', system_name)
             )
             destination_router = topology.add_or_get_router(norm_system_name)
             destination_interface = destination_router.add_interface(
@@ -82,74 +101,127 @@ def parse_isis(dump_folder):
     return topology
 
 
+def read_rt_entry(rt_entry):
+    """Extract the fields of an `rt-entry` element the parser cares about.
+
+    Returns a (destination, next hops) pair, where every next hop is a
+    (via, to, nh-type, nh-weight) tuple of element texts. Next hops without
+    an outgoing interface are dropped here.
+    """
+    next_hops = []
+    for x_nh in rt_entry.findall('{*}nh'):
+        # x_via is the outgoing interface
+        x_via = x_nh.find('{*}via')
+        if x_via is None or x_via.text is None:
+            # Weird built-in entry, skip
+            continue
+
+        x_nh_weight = x_nh.find('{*}nh-weight')
+        next_hops.append((
+            x_via.text,
+            x_nh.find('{*}to').text,
+            x_nh.find('{*}nh-type').text,
+            x_nh_weight.text if x_nh_weight is not None else None,
+        ))
+
+    return rt_entry.find('{*}rt-destination').text, next_hops
+
+
+def read_forwarding(file):
+    """Read the entries of a single forwarding table dump.
+
+    Returns a list of `read_rt_entry` results, in document order.
+    """
+    root = _parse_tree(file).getroot()
+    table = root.find('{*}forwarding-table-information')
+    return [
+        read_rt_entry(rt_entry)
+        for route_table in table.findall('{*}route-table')
+        for rt_entry in route_table.findall('{*}rt-entry')
+    ]
+
+
+def iter_forwarding(file):
+    """Stream the entries of a single forwarding table dump.
+
+    Yields the same entries as `read_forwarding`, but every `rt-entry` is
+    read as soon as it is complete and then freed, so memory use does not
+    depend on the size of the table.
+    """
+    context = etree.iterparse(
+        str(file),
+        tag='{*}rt-entry',
+        remove_blank_text=True,
+    )
+    for _, rt_entry in context:
+        entry = read_rt_entry(rt_entry)
+
+        # Free the entry and the already processed siblings before it
+        rt_entry.clear()
+        while rt_entry.getprevious() is not None:
+            del rt_entry.getparent()[0]
+
+        yield entry
+
+
 class ForwardingParser:
     def __init__(self, topology, ip_dns_map=None):
         self.topology = topology
         self.ip_dns_map = ip_dns_map if ip_dns_map is not None else dict()
 
-    def parse_forwarding(self, dump_folder):
-        path = pathlib.Path(dump_folder)
-        files = [node for node in path.iterdir() if node.is_file()]
+        self.Label = memoized(model.Label)
+
+    def parse_forwarding(self, dump_folder, jobs=1, streaming=False):
+        files = _dump_files(dump_folder)
+        reader = iter_forwarding if streaming else read_forwarding
 
         routing = model.Routing(dict())
-        for file in files:
+        for file, entries in zip(files, _map_files(reader, files, jobs)):
             lsi_list = []
             router = self.topology.get_router(file.stem)
             routing_table = routing.add_table(
                 model.RoutingTable(router)
             )
-            parser = etree.XMLParser(remove_blank_text=True)
-            tree = etree.parse(str(file), parser)
-            tree = ns_stripper(tree)
-
-            root = tree.getroot()
-            table = root.find('forwarding-table-information')
-            for route_table in table.findall('route-table'):
-                for rt_entry in route_table.findall('rt-entry'):
-                    self.parse_rt_entry(
-                        rt_entry,
-                        router,
-                        routing_table,
-                        lsi_list
-                    )
+            for entry in entries:
+                self.add_rt_entry(
+                    entry,
+                    router,
+                    routing_table,
+                    lsi_list
+                )
 
-            # Fixup LSI
-            for lsi_interface, out_interface, actions, weight in lsi_list:
-                matching_rules = (rule for rule in routing_table.rules
-                                  if rule.out_interface.name == lsi_interface)
-                for matching_rule in matching_rules:
-                    matching_rule.out_interface = out_interface
-                    matching_rule.actions.extend(actions)
-                    matching_rule.weight = weight
+            self.fixup_lsi(routing_table, lsi_list)
 
         self.fixup_labels(routing._routingTables.values())
 
         return model.Network(self.topology, routing)
 
     def parse_rt_entry(self, rt_entry, router, routing_table, lsi_list):
-        for x_nh in rt_entry.findall('nh'):
-            # x_via is the outgoing interface
-            x_via = x_nh.find('via')
-            if x_via is None or x_via.text is None:
-                # Weird built-in entry, skip
-                continue
-
+        self.add_rt_entry(
+            read_rt_entry(rt_entry),
+            router,
+            routing_table,
+            lsi_list
+        )
+
+    def add_rt_entry(self, entry, router, routing_table, lsi_list):
+        rt_destination, next_hops = entry
+        for via, to, nh_type, nh_weight in next_hops:
             # Destination IP
-            x_to = x_nh.find('to')
-            if x_to.text is None:
-                outgoing_interface = router.add_or_get_interface(x_via.text)
+            if to is None:
+                outgoing_interface = router.add_or_get_interface(via)
             else:
                 # If the interface is not present or not connected,
                 # it means we did not learn
                 # about the other router from the IS-IS database.
                 # This should only happen if we do not have any
                 # extracts from the destination router.
-                outgoing_interface = router.add_or_get_interface(x_via.text)
+                outgoing_interface = router.add_or_get_interface(via)
                 if outgoing_interface not in router.outgoing_links:
                     try:
-                        dest_router_name = self.ip_dns_map[x_to.text]
+                        dest_router_name = self.ip_dns_map[to]
                     except KeyError:
-                        dest_router_name = x_to.text.strip()
+                        dest_router_name = to.strip()
                     dest_router = self.topology.add_or_get_router(
                         dest_router_name
                     )
@@ -163,7 +235,7 @@ class ForwardingParser:
 
             # nh-type is the operation to perform on the packet.
             # This is a superset of the MPLS operations
-            nh_type = x_nh.find('nh-type').text.lower().replace('(top)', '')
+            nh_type = nh_type.lower().replace('(top)', '')
             op_sequence = [elem.strip() for elem in nh_type.split(',')]
             actions = []
             for op in op_sequence:
@@ -175,18 +247,16 @@ class ForwardingParser:
 
             # Weight of the rule. Lower is higher priority
             # May be absent, hence the None check
-            x_nh_weight = x_nh.find('nh-weight')
-            if x_nh_weight is not None:
-                weight = int(x_nh_weight.text, 16)
+            if nh_weight is not None:
+                weight = int(nh_weight, 16)
             else:
                 # No weight implies only a single alternative
                 # Set dummy weight
                 weight = 1
 
             # Incoming label or virtual interface
-            x_rt_destination = rt_entry.find('rt-destination')
-            if re.fullmatch(r'[\w=()]+', x_rt_destination.text):
-                label = model.Label(x_rt_destination.text)
+            if re.fullmatch(r'[\w=()]+', rt_destination):
+                label = self.Label(rt_destination)
                 routing_table.add_rule(
                     model.Rule(
                         label,
@@ -195,10 +265,10 @@ class ForwardingParser:
                         weight,
                     )
                 )
-            elif re.match(r'[\w./-]+', x_rt_destination.text):
+            elif re.match(r'[\w./-]+', rt_destination):
                 # Ethernet packet or LSI interface
                 # Cut off after whitespace
-                in_interface, *_ = x_rt_destination.text.split()
+                in_interface, *_ = rt_destination.split()
                 # Save LSI for later
                 if in_interface.lower().startswith('lsi'):
                     lsi_list.append((
@@ -223,12 +293,12 @@ class ForwardingParser:
         op, *rest = re.split(r'\s', action_str)
         if op == 'push':
             label_name, *rest = rest
-            action = model.PushAction(model.Label(label_name))
+            action = model.PushAction(self.Label(label_name))
         elif op == 'pop':
             action = model.PopAction()
         elif op == 'swap':
             label_name, *rest = rest
-            action = model.SwapAction(model.Label(label_name))
+            action = model.SwapAction(self.Label(label_name))
         else:
             raise RuntimeError(f'Invalid action {op}')
 
@@ -246,29 +316,51 @@ class ForwardingParser:
         else:
             raise RuntimeError('Unknown action type')
 
+    def with_bos(self, label, bos):
+        # Labels are interned, so never rename them in place. Build the name
+        # of the variant with the given bottom-of-stack bit instead
+        name = label.name
+        if name.endswith(('(S=0)', '(S=1)')):
+            name = name[:-len('(S=0)')]
+        return self.Label(f'{name}(S={bos})')
+
+    def fixup_lsi(self, routing_table, lsi_list):
+        # Index the rules by the name of their outgoing interface, moving
+        # them along as the LSI entries redirect them
+        rules_by_out_interface = defaultdict(list)
+        for rule in routing_table.rules:
+            rules_by_out_interface[rule.out_interface.name].append(rule)
+
+        for lsi_interface, out_interface, actions, weight in lsi_list:
+            matching_rules = rules_by_out_interface.pop(lsi_interface, [])
+            for matching_rule in matching_rules:
+                matching_rule.out_interface = out_interface
+                matching_rule.actions.extend(actions)
+                matching_rule.weight = weight
+            rules_by_out_interface[out_interface.name].extend(matching_rules)
+
     def fixup_labels(self, routing_tables):
         # Modify routing to pass along bottom-of-stack bit
         for table in routing_tables:
             mpls_rules = [rule for rule in table.rules
                           if isinstance(rule, model.Rule)]
-            # Extract rules with bottom_of_stack bit = 0
-            s0_rules = [rule for rule in mpls_rules
-                        if rule.label.name.endswith('(S=0)')]
+            # Names of the labels with bottom_of_stack bit = 0
+            s0_label_names = {rule.label.name for rule in mpls_rules
+                              if rule.label.name.endswith('(S=0)')}
             # Rules without bottom_of_stack bit
-            other_rules = [rule for rule in mpls_rules if rule not in s0_rules]
-            # Set bottom_of_stack bit to 1 for all unannotated rules
-            for rule in mpls_rules:
-                if not rule.label.name.endswith('(S=0)'):
-                    rule.label.name += '(S=1)'
-            # Find unpaired rules (rules without a different rule matching S=0)
-            s0_label_names = [rule.label.name for rule in s0_rules]
-            unpaired_rules = [rule for rule in other_rules
-                              if rule.label.name not in s0_label_names]
-            # Clone all unpaired rules and modify the clone to work with S=0
-            for rule in unpaired_rules:
+            other_rules = [rule for rule in mpls_rules
+                           if not rule.label.name.endswith('(S=0)')]
+            # Set bottom_of_stack bit to 1 for all unannotated rules, and
+            # clone the unpaired ones (rules without a different rule
+            # matching S=0) to work with S=0 as well
+            for rule in other_rules:
+                s0_label = self.with_bos(rule.label, 0)
+                rule.label = self.with_bos(rule.label, 1)
+                if s0_label.name in s0_label_names:
+                    continue
                 table.add_rule(
                     model.Rule(
-                        model.Label(rule.label.name.replace('(S=1)', '(S=0)')),
+                        s0_label,
                         rule.out_interface,
                         tuple([self.clone_action(action)
                                for action in rule.actions]),
@@ -276,71 +368,60 @@ class ForwardingParser:
                     )
                 )
 
-        # Fix actions for all rules
+        # Fix actions for all rules. Actions may be shared between rules,
+        # so every rule gets fixed copies instead of modifying them in place
         for table in routing_tables:
             for rule in table.rules:
                 if isinstance(rule, model.Rule):
-                    for action in rule.actions:
-                        if isinstance(action, model.PopAction):
-                            # Do nothing
-                            pass
-                        elif isinstance(action, model.PushAction):
-                            # Always push (S=0) variant
-                            if action.label.name.endswith('(S=1)'):
-                                action.label.name = (
-                                    action.label.name.replace('(S=1)', '(S=0)')
-                                )
-                            else:
-                                action.label.name = action.label.name + '(S=0)'
-                        elif isinstance(action, model.SwapAction):
-                            # Swap to the label with the same BoS bit
-                            if rule.label.name.endswith('(S=0)'):
-                                if action.label.name.endswith('(S=1)'):
-                                    action.label.name = (
-                                        action.label.name.replace('(S=1)', '(S=0)')  # noqa
-                                    )
-                                else:
-                                    action.label.name = action.label.name + '(S=0)'  # noqa
-                            elif rule.label.name.endswith('(S=1)'):
-                                if action.label.name.endswith('(S=0)'):
-                                    action.label.name = (
-                                        action.label.name.replace('(S=0)', '(S=1)')  # noqa
-                                    )
-                                else:
-                                    action.label.name = action.label.name + '(S=1)'  # noqa
-                            else:
-                                # This should not happen.
-                                # All rules should have been fixed above
-                                # Panic!
-                                raise RuntimeError('Something has gone horribly wrong')  # noqa
-                        else:
-                            raise RuntimeError(
-                                "Someone added a new rule type and forgot this code"  # noqa
-                            )
+                    rule.actions = [self.fix_mpls_action(rule, action)
+                                    for action in rule.actions]
                 elif isinstance(rule, model.EthernetRule):
-                    for action in rule.actions:
-                        if isinstance(action, model.PopAction):
-                            # No MPLS labels on stack for EthernetRules
-                            # Popping is illegal
-                            raise RuntimeError('PopAction is illegal for EthernetRule')  # noqa
-                        elif isinstance(action, model.PushAction):
-                            # Always push (S=1) variant
-                            if action.label.name.endswith('(S=0)'):
-                                action.label.name = (
-                                    action.label.name.replace('(S=0)', '(S=1)')
-                                )
-                            else:
-                                action.label.name = action.label.name + '(S=0)'
-                        elif isinstance(action, model.SwapAction):
-                            # No MPLS labels on stack for EthernetRules
-                            # Swapping is illegal
-                            raise RuntimeError('SwapAction is illegal for EthernetRule')  # noqa
-                        else:
-                            raise RuntimeError(
-                                "Someone added a new rule type and forgot this code"  # noqa
-                            )
+                    rule.actions = [self.fix_ethernet_action(action)
+                                    for action in rule.actions]
                 else:
                     # wtf?
                     raise RuntimeError(
                         "Someone added a new rule type and forgot this code"
                     )
+
+    def fix_mpls_action(self, rule, action):
+        if isinstance(action, model.PopAction):
+            # Do nothing
+            return action
+        elif isinstance(action, model.PushAction):
+            # Always push (S=0) variant
+            return model.PushAction(self.with_bos(action.label, 0))
+        elif isinstance(action, model.SwapAction):
+            # Swap to the label with the same BoS bit
+            if rule.label.name.endswith('(S=0)'):
+                return model.SwapAction(self.with_bos(action.label, 0))
+            elif rule.label.name.endswith('(S=1)'):
+                return model.SwapAction(self.with_bos(action.label, 1))
+            else:
+                # This should not happen.
+                # All rules should have been fixed above
+                # Panic!
+                raise RuntimeError('Something has gone horribly wrong')
+        else:
+            raise RuntimeError(
+                "Someone added a new rule type and forgot this code"
+            )
+
+    def fix_ethernet_action(self, action):
+        if isinstance(action, model.PopAction):
+            # No MPLS labels on stack for EthernetRules
+            # Popping is illegal
+            raise RuntimeError('PopAction is illegal for EthernetRule')
+        elif isinstance(action, model.PushAction):
+            if action.label.name.endswith('(S=0)'):
+                return model.PushAction(self.with_bos(action.label, 1))
+            else:
+                return model.PushAction(self.with_bos(action.label, 0))
+        elif isinstance(action, model.SwapAction):
+            # No MPLS labels on stack for EthernetRules
+            # Swapping is illegal
+            raise RuntimeError('SwapAction is illegal for EthernetRule')
+        else:
+            raise RuntimeError(
+                "Someone added a new rule type and forgot this code"
+            )
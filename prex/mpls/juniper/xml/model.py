@@ -336,17 +336,15 @@ class PRNMLConverter():
         return [(rule.weight, prnml_rule)]
 
     def visit_rule(self, rule, prnml_router):
-        prnml_rules = []
-        for _, interface in prnml_router.interfaces.items():
-            prnml_rule = self.Rule(
-                interface,
-                prnml_router.getInterface(rule.out_interface.name),
-                rule.label.visit(self),
-                tuple([action.visit(self) for action in rule.actions]),
-            )
-            prnml_rules.append((rule.weight, prnml_rule))
+        # Labels are matched regardless of the ingress interface
+        prnml_rule = self.Rule(
+            prnml.ANY_INTERFACE,
+            prnml_router.getInterface(rule.out_interface.name),
+            rule.label.visit(self),
+            tuple([action.visit(self) for action in rule.actions]),
+        )
 
-        return prnml_rules
+        return [(rule.weight, prnml_rule)]
 
     def visit_pop_action(self, action):
         return prnml.PopAction()
@@ -25,7 +25,8 @@ for i, _ in enumerate(network.topology.links):
         # remove link and rules ?!?
         to_delete = list()
 
-        for (from_, label), dest in tmp_network.routing._routingTables[si.router].destinations.items():
+        routing_table = tmp_network.routing.get_table(si.router)
+        for (from_, label), dest in routing_table.destinations.items():
             if from_ == si.interface:
                 to_delete.append((from_, label,))
                 continue
@@ -40,7 +41,7 @@ for i, _ in enumerate(network.topology.links):
 
 
         for td in to_delete:
-            del tmp_network.routing._routingTables[si.router].destinations[td]
+            routing_table.remove_destination(*td)
 
     tmp_network.topology.links.remove(link)
     topology_str, routing_str = x.write_network(tmp_network)
@@ -0,0 +1,351 @@
+from . import graph
+
+from collections import defaultdict
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# The subset construction gives up once it finds this many times the
+# locations of the NFA
+SUBSET_LIMIT = 4
+
+
+def _epsilon_closure(location):
+    closure = {location}
+    backlog = [location]
+    while backlog:
+        for transition in backlog.pop()._outgoing:
+            if (isinstance(transition, graph.EpsilonTransition)
+                    and transition.to not in closure):
+                closure.add(transition.to)
+                backlog.append(transition.to)
+    return closure
+
+
+def _search(start, edges):
+    found = {start}
+    backlog = [start]
+    while backlog:
+        for location in edges[backlog.pop()]:
+            if location not in found:
+                found.add(location)
+                backlog.append(location)
+    return found
+
+
+def _trim(edges, initial, final):
+    # Only keep the edges on some path from the initial to the final location
+    forward = defaultdict(list)
+    backward = defaultdict(list)
+    for from_, _, to in edges:
+        forward[from_].append(to)
+        backward[to].append(from_)
+    reachable = _search(initial, forward)
+    coreachable = _search(final, backward)
+    return {
+        (from_, symbol, to) for from_, symbol, to in edges
+        if from_ in reachable and to in coreachable
+    }
+
+
+def _merge_equivalent(edges, final):
+    # Locations with the same transitions out of them accept the same words,
+    # so one of them can stand in for all. Merging can make more of them the
+    # same, so this is repeated until nothing changes.
+    representatives = {}
+    while True:
+        outgoing = defaultdict(set)
+        for from_, symbol, to in edges:
+            outgoing[from_].add((symbol, to))
+
+        groups = {}
+        merged = {}
+        for location, transitions in outgoing.items():
+            if location is final:
+                continue
+            representative = groups.setdefault(frozenset(transitions),
+                                               location)
+            if representative is not location:
+                merged[location] = representative
+        if not merged:
+            return edges, representatives
+
+        for location, representative in representatives.items():
+            representatives[location] = merged.get(representative,
+                                                   representative)
+        representatives.update(merged)
+        edges = {
+            (merged.get(from_, from_), symbol, merged.get(to, to))
+            for from_, symbol, to in edges
+        }
+
+
+def remove_epsilons(nfa):
+    """Build an NFA without epsilon transitions accepting the same language.
+
+    Every location takes the symbol transitions of its epsilon closure. As
+    there is only one final location, a transition into a location with the
+    final one in its closure also gets a copy into the final location. Only
+    the empty word still needs an epsilon transition, from the initial to the
+    final location.
+
+    Locations that can't be on an accepting run are left out, and locations
+    with the same transitions are merged, as the closures would otherwise
+    copy the loops of Kleene stars.
+    """
+    closures = {location: _epsilon_closure(location)
+                for location in nfa.locations}
+
+    edges = set()
+    for from_ in nfa.locations:
+        for middle in closures[from_]:
+            for transition in middle._outgoing:
+                if isinstance(transition, graph.EpsilonTransition):
+                    continue
+                edges.add((from_, transition.symbol.value, transition.to))
+                if nfa.final in closures[transition.to]:
+                    edges.add((from_, transition.symbol.value, nfa.final))
+    # The epsilon transition for the empty word, kept as an edge without a
+    # symbol so the initial location isn't merged with others
+    if nfa.final in closures[nfa.initial] and nfa.initial is not nfa.final:
+        edges.add((nfa.initial, None, nfa.final))
+
+    edges = _trim(edges, nfa.initial, nfa.final)
+    edges, representatives = _merge_equivalent(edges, nfa.final)
+    initial = representatives.get(nfa.initial, nfa.initial)
+
+    result = graph.NFA()
+    locations = {}
+    symbols = {}
+
+    def location(old):
+        if old not in locations:
+            if old is initial:
+                locations[old] = result.start_location(old.name)
+            elif old is nfa.final:
+                locations[old] = result.end_location(old.name)
+            else:
+                locations[old] = result.location(old.name)
+        return locations[old]
+
+    def symbol(value):
+        if value not in symbols:
+            symbols[value] = result.symbol(value)
+        return symbols[value]
+
+    # The initial and final location always exist, even if nothing is
+    # accepted
+    location(initial)
+    location(nfa.final)
+    if initial is nfa.final:
+        result.final = locations[initial]
+
+    for from_, value, to in edges:
+        if value is None:
+            result.epsilon_transition(location(from_), location(to)).attach()
+        else:
+            result.transition(
+                location(from_),
+                location(to),
+                symbol(value),
+            ).attach()
+
+    logger.info(
+        f"Removed epsilons from the NFA, {len(nfa.transitions)} transitions"
+        f" and {len(nfa.locations)} locations became"
+        f" {len(result.transitions)} and {len(result.locations)}"
+    )
+    return result
+
+
+def _subsets(nfa, limit=None):
+    # Subset construction, as a list of transitions of every subset by symbol
+    # value and the subsets containing the final location. None past `limit`.
+    closures = {}
+
+    def closure(locations):
+        result = set()
+        for location in locations:
+            if location not in closures:
+                closures[location] = _epsilon_closure(location)
+            result |= closures[location]
+        return frozenset(result)
+
+    subsets = [closure([nfa.initial])]
+    index = {subsets[0]: 0}
+    delta = []
+    while len(delta) < len(subsets):
+        moves = defaultdict(set)
+        for location in subsets[len(delta)]:
+            for transition in location._outgoing:
+                if not isinstance(transition, graph.EpsilonTransition):
+                    moves[transition.symbol.value].add(transition.to)
+
+        targets = {}
+        for symbol, locations in moves.items():
+            subset = closure(locations)
+            if subset not in index:
+                if limit is not None and len(subsets) >= limit:
+                    return None
+                index[subset] = len(subsets)
+                subsets.append(subset)
+            targets[symbol] = index[subset]
+        delta.append(targets)
+
+    accepting = {i for i, subset in enumerate(subsets) if nfa.final in subset}
+    return delta, accepting
+
+
+def _live_states(delta, accepting):
+    backward = defaultdict(list)
+    for state, targets in enumerate(delta):
+        for to in targets.values():
+            backward[to].append(state)
+    live = set(accepting)
+    backlog = list(accepting)
+    while backlog:
+        for state in backward[backlog.pop()]:
+            if state not in live:
+                live.add(state)
+                backlog.append(state)
+    return live
+
+
+def _hopcroft(delta, accepting):
+    # Partition the states of a trimmed, partial DFA into blocks of states
+    # accepting the same words. Every initial block is a splitter, as the
+    # missing transitions go to a sink outside of all blocks.
+    predecessors = [defaultdict(list) for _ in delta]
+    for state, targets in enumerate(delta):
+        for symbol, to in targets.items():
+            predecessors[to][symbol].append(state)
+
+    blocks = [block for block in (set(accepting),
+                                  set(range(len(delta))) - set(accepting))
+              if block]
+    block_of = [None] * len(delta)
+    for i, block in enumerate(blocks):
+        for state in block:
+            block_of[state] = i
+
+    waiting = set(range(len(blocks)))
+    while waiting:
+        splitter = list(blocks[waiting.pop()])
+        entering = defaultdict(set)
+        for state in splitter:
+            for symbol, froms in predecessors[state].items():
+                entering[symbol].update(froms)
+
+        for froms in entering.values():
+            touched = defaultdict(set)
+            for state in froms:
+                touched[block_of[state]].add(state)
+            for i, inside in touched.items():
+                if len(inside) == len(blocks[i]):
+                    continue
+                blocks[i] -= inside
+                blocks.append(inside)
+                for state in inside:
+                    block_of[state] = len(blocks) - 1
+                if i in waiting or len(inside) <= len(blocks[i]):
+                    waiting.add(len(blocks) - 1)
+                else:
+                    waiting.add(i)
+    return blocks, block_of
+
+
+def determinize(nfa, prefix, limit=None):
+    """Build the minimal DFA accepting the same language as `nfa`.
+
+    Locations are named `prefix` and a number. The result is still an NFA
+    with a single final location: if several locations of the DFA accept,
+    the transitions into them get a copy into an extra final location, and
+    the empty word an epsilon transition. None if the subset construction
+    finds more than `limit` locations.
+    """
+    subsets = _subsets(nfa, limit)
+    if subsets is None:
+        return None
+    delta, accepting = subsets
+
+    # The initial subset always stays, even if nothing is accepted
+    live = _live_states(delta, accepting) | {0}
+    states = sorted(live)
+    renumber = {state: i for i, state in enumerate(states)}
+    delta = [
+        {symbol: renumber[to] for symbol, to in delta[state].items()
+         if to in live}
+        for state in states
+    ]
+    accepting = {renumber[state] for state in accepting}
+    blocks, block_of = _hopcroft(delta, accepting)
+
+    result = graph.NFA()
+    symbols = {}
+
+    def symbol(value):
+        if value not in symbols:
+            symbols[value] = result.symbol(value)
+        return symbols[value]
+
+    initial = block_of[0]
+    final_blocks = {block_of[state] for state in accepting}
+    locations = []
+    for i in range(len(blocks)):
+        name = f'{prefix}_{i}'
+        if i == initial:
+            locations.append(result.start_location(name))
+        elif len(final_blocks) == 1 and i in final_blocks:
+            locations.append(result.end_location(name))
+        else:
+            locations.append(result.location(name))
+    if len(final_blocks) == 1:
+        (final,) = final_blocks
+        if final == initial:
+            result.final = locations[initial]
+    else:
+        result.end_location(f'{prefix}_{len(blocks)}')
+
+    for i, block in enumerate(blocks):
+        for value, to in delta[next(iter(block))].items():
+            to = block_of[to]
+            result.transition(
+                locations[i],
+                locations[to],
+                symbol(value),
+            ).attach()
+            if len(final_blocks) != 1 and to in final_blocks:
+                result.transition(
+                    locations[i],
+                    result.final,
+                    symbol(value),
+                ).attach()
+
+    if len(final_blocks) != 1 and initial in final_blocks:
+        result.epsilon_transition(locations[initial], result.final).attach()
+
+    return result
+
+
+def simplify(nfa, prefix):
+    """The smaller of `nfa` without epsilons and its minimal DFA.
+
+    `determinize` gives up when the DFA gets much larger than `nfa`.
+    """
+    candidate = remove_epsilons(nfa)
+    deterministic = determinize(nfa, prefix,
+                                limit=SUBSET_LIMIT * len(nfa.locations))
+    if deterministic is not None and (
+            (len(deterministic.transitions), len(deterministic.locations))
+            <= (len(candidate.transitions), len(candidate.locations))):
+        candidate = deterministic
+
+    logger.info(
+        f"Simplified the NFA from {len(nfa.locations)} locations and"
+        f" {len(nfa.transitions)} transitions to"
+        f" {len(candidate.locations)} and {len(candidate.transitions)}"
+        f"{' by determinizing' if candidate is deterministic else ''}"
+    )
+    return candidate
@@ -0,0 +1,143 @@
+import contextlib
+import gc
+import hashlib
+import logging
+import os
+import pathlib
+import pickle
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+# Bump whenever the loaders or the prnml model change in a way that makes
+# previously cached networks wrong
+CACHE_VERSION = 4
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = pathlib.Path.home() / '.cache'
+    return pathlib.Path(base) / 'prex'
+
+
+def _input_files(path):
+    path = pathlib.Path(path)
+    if path.is_dir():
+        return sorted(node for node in path.iterdir() if node.is_file())
+    return [path]
+
+
+def input_digest(kind, paths):
+    """Hash the contents of the input files of a loader.
+
+    `paths` are files or directories, in the order the loader takes them.
+    Directories are hashed file by file in name order.
+    """
+    digest = hashlib.sha256()
+    digest.update(f'{CACHE_VERSION}:{kind}'.encode())
+    for path in paths:
+        digest.update(b'\0path')
+        for file in _input_files(path):
+            digest.update(f'\0{file.name}\0'.encode())
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def _without_gc():
+    # The network is millions of small objects that all survive, having the
+    # collector walk them while (un)pickling only costs time
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class NetworkCache(object):
+    """On-disk cache of loaded prnml networks, keyed by `input_digest`.
+
+    Other kinds of entries, e.g. pushdown fragments, can be kept in the same
+    directory as plain bytes with `read` and `write`.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = pathlib.Path(
+            directory if directory is not None else default_cache_dir()
+        )
+
+    def _path(self, key):
+        return self.directory / f'{key}.network'
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f, _without_gc():
+                network = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError, TypeError, ValueError) as e:
+            # Entries pickled by older code can fail in about any of these
+            logger.warning(f'Ignoring unreadable cache entry {path}: {e}')
+            return None
+        logger.info(f'Loaded network from {path}')
+        return network
+
+    def store(self, key, network):
+        """Write `network` to the cache.
+
+        The cache is best-effort: if it can't be written, a warning is logged
+        and the next run loads the network from its input again.
+        """
+        def dump(f):
+            with _without_gc():
+                pickle.dump(network, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if self._write(self._path(key), dump):
+            logger.info(f'Stored network in {self._path(key)}')
+
+    def read(self, name):
+        """The bytes of the entry `name` of other kinds, None if missing."""
+        path = self.directory / name
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f'Ignoring unreadable cache entry {path}: {e}')
+            return None
+
+    def write(self, name, data):
+        """Write the entry `name` of other kinds, best-effort like `store`."""
+        return self._write(self.directory / name, lambda f: f.write(data))
+
+    def _write(self, path, dump):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Write next to the final entry and rename, so concurrent runs
+            # never see a half written file
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        except OSError as e:
+            logger.warning(f'Not caching {path.name} in {self.directory}: {e}')
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                dump(f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            logger.warning(f'Not caching {path.name} in {self.directory}: {e}')
+            return False
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return True
@@ -8,6 +8,25 @@ class Interface(object):
         return f"<Interface {self.name!r}@{id(self)}>"
 
 
+class AnyInterface(object):
+    """Stands in for every interface of a router.
+
+    Destinations and rules from it apply to packets arriving on any
+    interface, e.g. MPLS labels, which are matched regardless of ingress.
+    """
+    name = '*'
+
+    def __repr__(self):
+        return '<Interface *>'
+
+    def __reduce__(self):
+        # Keep it a singleton through pickling
+        return 'ANY_INTERFACE'
+
+
+ANY_INTERFACE = AnyInterface()
+
+
 class Router(object):
     def __init__(self, name, interfaces=None):
         self.name = name
@@ -129,15 +148,30 @@ class RoutingTable(object):
     def __init__(self, router, destinations):
         self.router = router
         # dict: (from_, label) -> destination
+        # Change it through set_destination/remove_destination only, so the
+        # indexes below stay up to date
         self.destinations = destinations
+        # dict: from_ -> label -> destination
+        self._by_from = {}
+        for (from_, label), destination in destinations.items():
+            self._by_from.setdefault(from_, {})[label] = destination
+        self._labels = None
 
     def get_destination(self, from_, label):
         return self.destinations[(from_, label)]
 
     def get_destinations_from(self, from_):
-        for (dest_from, _), destination in self.destinations.items():
-            if dest_from == from_:
-                yield destination
+        yield from self._by_from.get(from_, {}).values()
+
+    def get_destinations_matching(self, interface):
+        """Destinations applying to packets arriving on `interface`.
+
+        These are the destinations from the interface itself as well as the
+        ones from ANY_INTERFACE.
+        """
+        yield from self.get_destinations_from(interface)
+        if interface is not ANY_INTERFACE:
+            yield from self.get_destinations_from(ANY_INTERFACE)
 
     def get_destinations_label(self, label):
         for (_, dest_label), destination in self.destinations.items():
@@ -145,17 +179,32 @@ class RoutingTable(object):
                 yield destination
 
     def set_destination(self, destination):
-        self.destinations[(destination.from_, destination.label)] = destination
+        from_, label = destination.from_, destination.label
+        self.destinations[(from_, label)] = destination
+        self._by_from.setdefault(from_, {})[label] = destination
+        self._labels = None
+
+    def remove_destination(self, from_, label):
+        del self.destinations[(from_, label)]
+        by_label = self._by_from[from_]
+        del by_label[label]
+        if not by_label:
+            del self._by_from[from_]
+        self._labels = None
 
     def count_rules(self):
         return sum(destination.count_rules()
                    for destination in self.destinations.values())
 
     def collect_labels(self):
-        labels = set()
-        for destination in self.destinations.values():
-            labels.update(destination.collect_labels())
-        return labels
+        # Cached until the destinations change. Destinations changed in place
+        # have to be set again for the cache to notice.
+        if self._labels is None:
+            labels = set()
+            for destination in self.destinations.values():
+                labels.update(destination.collect_labels())
+            self._labels = frozenset(labels)
+        return self._labels
 
 
 class Label(object):
@@ -312,20 +361,32 @@ class Topology(object):
 class Routing(object):
     def __init__(self, routingTable):
         self._routingTables = routingTable
+        self._labels = None
+        self._table_labels = ()
 
     @property
     def routingTables(self):
         return self._routingTables.items()
 
+    def get_table(self, router):
+        return self._routingTables.get(router)
+
     def count_rules(self):
         return sum(routing_table.count_rules()
                    for routing_table in self._routingTables.values())
 
     def collect_labels(self):
-        labels = set()
-        for routing_table in self._routingTables.values():
-            labels.update(routing_table.collect_labels())
-        return labels
+        # The tables cache their own labels, only redo the union if one of
+        # them (or the set of tables) changed since last time
+        table_labels = tuple(routing_table.collect_labels()
+                             for routing_table in self._routingTables.values())
+        if (self._labels is None
+                or len(table_labels) != len(self._table_labels)
+                or any(new is not old for new, old
+                       in zip(table_labels, self._table_labels))):
+            self._labels = frozenset().union(*table_labels)
+            self._table_labels = table_labels
+        return self._labels
 
 
 class Network(object):
@@ -2,6 +2,8 @@ from lxml import etree
 from prex.prnml import model
 from prex.util import memoized
 from itertools import groupby
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 
 
 def get_routers(routers_tree):
@@ -104,7 +106,11 @@ def get_destinations(destinations_tree, router):
     destinations = {}
     for ddef in destinations_tree.findall("destination"):
         try:
-            from_ = router.interfaces[ddef.get("from")]
+            from_name = ddef.get("from")
+            if from_name == model.ANY_INTERFACE.name:
+                from_ = model.ANY_INTERFACE
+            else:
+                from_ = router.interfaces[from_name]
         except Exception as e:
             print(router)
             raise e
@@ -117,39 +123,53 @@ def get_destinations(destinations_tree, router):
     return destinations
 
 
+def get_routing(rdef, topology):
+    for_ = topology.router_by_name(rdef.get("for"))
+    destinations = get_destinations(rdef.find("destinations"), for_)
+    return for_, model.RoutingTable(for_, destinations)
+
+
 def get_routings(routings_tree, topology):
     routings = {}
     for rdef in routings_tree.findall("routing"):
-        for_ = topology.router_by_name(rdef.get("for"))
-        destinations = get_destinations(rdef.find("destinations"), for_)
-        routings[for_] = model.RoutingTable(for_, destinations)
+        for_, routing_table = get_routing(rdef, topology)
+        routings[for_] = routing_table
     return routings
 
 
+def _source(file_):
+    # iterparse only takes paths and file objects, while etree.parse also
+    # takes file:// URIs
+    if isinstance(file_, str) and urlparse(file_).scheme == 'file':
+        return url2pathname(urlparse(file_).path)
+    return file_
+
+
 def read_topology(file_):
     parser = etree.XMLParser(remove_blank_text=True)
     tree = etree.parse(file_, parser)
 
-    # Take out all the useless whitespace
-    for element in tree.iter("*"):
-        if element.text is not None and not element.text.strip():
-            element.text = None
-
     routers = get_routers(tree.find("routers"))
     links = get_links(tree.find("links"), routers)
     return model.Topology(routers, links)
 
 
 def read_routing(file_, topology):
-    parser = etree.XMLParser(remove_blank_text=True)
-    rtree = etree.parse(file_, parser)
-
-    # Take out all the useless whitespace
-    for element in rtree.iter("*"):
-        if element.text is not None and not element.text.strip():
-            element.text = None
+    """Read a routing file, one `<routing>` element at a time.
 
-    routings = get_routings(rtree.find("routings"), topology)
+    Each routing table is built as soon as its element is complete, after
+    which the element is dropped again. Only a single table is kept in
+    memory as XML at any point.
+    """
+    routings = {}
+    for _, rdef in etree.iterparse(_source(file_), tag="routing",
+                                   remove_blank_text=True):
+        for_, routing_table = get_routing(rdef, topology)
+        routings[for_] = routing_table
+
+        rdef.clear()
+        while rdef.getprevious() is not None:
+            del rdef.getparent()[0]
     return model.Routing(routings)
 
 
@@ -211,13 +231,63 @@ def write_routing(routing):
     # Serialize routing table
     x_routings = etree.SubElement(x_routes, 'routings')
     for route_table in routing._routingTables.values():
-        x_routing = etree.SubElement(x_routings, 'routing',
-                                     attrib={'for': route_table.router.name})
-        x_routing.append(write_destinations(route_table.destinations.values()))
+        x_routings.append(write_routing_table(route_table))
 
     return x_routes
 
 
+def write_routing_table(route_table):
+    x_routing = etree.Element('routing',
+                              attrib={'for': route_table.router.name})
+    x_routing.append(write_destinations(route_table.destinations.values()))
+    return x_routing
+
+
+def _indent(element, level):
+    # Same layout as pretty_print, for elements written into an xmlfile at
+    # the given depth
+    indent = '\n' + '  ' * (level + 1)
+    if len(element):
+        element.text = indent
+        for child in element:
+            _indent(child, level + 1)
+            child.tail = indent
+        child.tail = indent[:-2]
+
+
+def stream_network(network, topology_f, routing_f, pretty_print=True):
+    """Write a network to two binary files.
+
+    The routing is written one routing table at a time, so only a single
+    table is ever held as XML.
+    """
+    topology_f.write(etree.tostring(write_topology(network.topology),
+                                    encoding='utf-8',
+                                    pretty_print=pretty_print))
+    stream_routing(network.routing, routing_f, pretty_print)
+
+
+def stream_routing(routing, routing_f, pretty_print=True):
+    def newline(level):
+        if pretty_print:
+            xf.write('\n' + '  ' * level)
+
+    with etree.xmlfile(routing_f, encoding='utf-8') as xf:
+        with xf.element('routes'):
+            newline(1)
+            with xf.element('routings'):
+                for route_table in routing._routingTables.values():
+                    newline(2)
+                    x_routing = write_routing_table(route_table)
+                    if pretty_print:
+                        _indent(x_routing, 2)
+                    xf.write(x_routing)
+                newline(1)
+            newline(0)
+    if pretty_print:
+        routing_f.write(b'\n')
+
+
 def write_destinations(destinations):
     x_destinations = etree.Element('destinations')
     for destination in destinations:
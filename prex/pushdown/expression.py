@@ -44,7 +44,6 @@ class EmptyExpression(TerminalExpression):
         return '1 = 1'
 
 
-@memoized
 class AndExpression(TerminalExpression):
     def __init__(self, e1, e2):
         self._e1 = e1
@@ -67,7 +66,6 @@ class OrExpression(TerminalExpression):
         return f"({self.e1} | {self.e2})"
 
 
-@memoized
 class SetExpression(TerminalExpression):
     def __init__(self, var, value):
         self._var = var
@@ -118,9 +116,10 @@ class AddExpression(object):
 
 
 class Variable(object):
-    def __init__(self, name, id_):
+    def __init__(self, name, id_, bits):
         self.name = name
         self.id_ = id_
+        self.bits = bits
 
     def __str__(self):
         return self.name
@@ -130,19 +129,24 @@ class Generator(object):
     def __init__(self):
         self.keepvars = set()
         self.free = [i for i in range(9, -1, -1)]
-        self.used = set()
-
-    def alloc_variable(self):
+        # dict: name -> bits, of every variable ever allocated
+        self.used = {}
+        # The same expressions are asked for over and over, memoized here so
+        # they go away with the generator and its variables
+        self.And = memoized(AndExpression)
+        self.Set = memoized(SetExpression)
+
+    def alloc_variable(self, bits=4):
         next_ = self.free.pop()
-        var = Variable(f"var_{next_}", next_)
-        self.used.add(var.name)
+        var = Variable(f"var_{next_}", next_, bits)
+        self.used[var.name] = max(bits, self.used.get(var.name, 0))
         self.keepvars.add(var)
 
         return var
 
     @contextmanager
-    def variable(self, name):
-        var = self.alloc_variable()
+    def variable(self, name, bits=4):
+        var = self.alloc_variable(bits)
         try:
             yield var
         finally:
@@ -160,6 +164,9 @@ class Generator(object):
         for var in self.keepvars:
             if var in exclude:
                 continue
-            expression &= SetExpression(var, var)
+            if isinstance(expression, EmptyExpression):
+                expression = self.Set(var, var)
+            else:
+                expression = self.And(expression, self.Set(var, var))
 
         return expression
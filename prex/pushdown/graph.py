@@ -1,79 +1,153 @@
+"""Pushdown automata.
+
+A `PDA` is stored as a struct of arrays: locations are numbered in order of
+creation and every transition is one entry in a set of parallel integer arrays
+(source, target, input symbol, action, guard). Labels and actions are
+flyweights shared by all automata and stored by their id, guards are interned
+per automaton, so a transition only costs a handful of machine integers and
+moving transitions between automata needs no translation.
+
+`Location`, `Transition` and `StarTransition` are thin views over those arrays
+that are created on access, so the visitor interface works as it always has.
+Whole-graph passes should go through the arrays directly.
+"""
+from array import array
+from itertools import count
+from weakref import WeakValueDictionary
+
+
+# Input symbol of star transitions in `PDA.inlabels`
+STAR = -1
+
+# `Action.kind`
+POP = 0
+PUSH = 1
+REPLACE = 2
+PUSHREPLACE = 3
+NOOP = 4
+
+
 class Location(object):
-    def __init__(self, pda, name):
-        self.name = name
-        self._incoming = []
-        self._outgoing = []
+    __slots__ = ('pda', 'id')
 
-        pda.attach_location(self)
+    def __init__(self, pda, id_):
+        self.pda = pda
+        self.id = id_
+
+    @property
+    def name(self):
+        return self.pda.location_names[self.id]
 
-    def attach_outgoing(self, transition):
-        self._outgoing.append(transition)
+    @property
+    def _outgoing(self):
+        return [self.pda.transition_view(transition)
+                for transition in self.pda.outgoing(self.id)]
 
-    def attach_incoming(self, transition):
-        self._incoming.append(transition)
+    @property
+    def _incoming(self):
+        return [self.pda.transition_view(transition)
+                for transition in self.pda.incoming(self.id)]
 
     def visit(self, visitor, *args, **kwargs):
         return visitor.visit_location(self, *args, **kwargs)
 
+    def __eq__(self, other):
+        return (isinstance(other, Location)
+                and self.pda is other.pda
+                and self.id == other.id)
+
+    def __hash__(self):
+        return hash((id(self.pda), self.id))
+
     def __repr__(self):
-        return f"<Location {self.name}@{id(self)}>"
+        return f"<Location {self.name}@{self.id}>"
 
 
-class PopAction(object):
-    def __init__(self):
-        pass
+class _Flyweight(object):
+    """Interned by constructor arguments, immutable and shared by all PDAs.
 
-    def visit(self, visitor, *args, **kwargs):
-        return visitor.visit_pop(self, *args, **kwargs)
+    Instances are numbered from a counter that is never reused, so an id stays
+    valid for as long as something holds on to its instance.
+    """
+    __slots__ = ('id', '__weakref__')
+    _fields = ()
+
+    def __new__(cls, *args):
+        key = (cls, ) + args
+        instance = cls._instances.get(key)
+        if instance is None:
+            instance = object.__new__(cls)
+            for field, value in zip(cls._fields, args):
+                object.__setattr__(instance, field, value)
+            object.__setattr__(instance, 'id', next(cls._ids))
+            cls._instances[key] = instance
+        return instance
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, field)
+                                  for field in self._fields))
+
+
+class Action(_Flyweight):
+    __slots__ = ()
+    _instances = WeakValueDictionary()
+    _ids = count()
+
+    def operands(self):
+        return tuple(getattr(self, field) for field in self._fields)
 
     def labels(self):
-        return set()
+        return set(self.operands())
 
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.operands()!r}>"
 
-class PushAction(object):
-    def __init__(self, label):
-        self.label = label
+
+class PopAction(Action):
+    __slots__ = ()
+    kind = POP
 
     def visit(self, visitor, *args, **kwargs):
-        return visitor.visit_push(self, *args, **kwargs)
+        return visitor.visit_pop(self, *args, **kwargs)
 
-    def labels(self):
-        return {self.label}
 
+class PushAction(Action):
+    __slots__ = ('label', )
+    _fields = __slots__
+    kind = PUSH
+
+    def visit(self, visitor, *args, **kwargs):
+        return visitor.visit_push(self, *args, **kwargs)
 
-class ReplaceAction(object):
-    def __init__(self, label):
-        self.label = label
+
+class ReplaceAction(Action):
+    __slots__ = ('label', )
+    _fields = __slots__
+    kind = REPLACE
 
     def visit(self, visitor, *args, **kwargs):
         return visitor.visit_replace(self, *args, **kwargs)
 
-    def labels(self):
-        return {self.label}
-
 
-class PushReplaceAction(object):
-    def __init__(self, label1, label2):
-        self.label1 = label1
-        self.label2 = label2
+class PushReplaceAction(Action):
+    __slots__ = ('label1', 'label2')
+    _fields = __slots__
+    kind = PUSHREPLACE
 
     def visit(self, visitor, *args, **kwargs):
         return visitor.visit_pushreplace(self, *args, **kwargs)
 
-    def labels(self):
-        return {self.label1, self.label2}
-
 
-class NoopAction(object):
-    def __init__(self):
-        pass
+class NoopAction(Action):
+    __slots__ = ()
+    kind = NOOP
 
     def visit(self, visitor, *args, **kwargs):
         return visitor.visit_noop(self, *args, **kwargs)
 
-    def labels(self):
-        return set()
-
 
 class Guard(object):
     def __init__(self, expression=None):
@@ -82,23 +156,23 @@ class Guard(object):
     def visit(self, visitor, *args, **kwargs):
         return visitor.visit_guard(self, *args, **kwargs)
 
+    def __reduce__(self):
+        # Only the text of the expression is ever used once it is in a guard
+        if self.expression is None:
+            return (Guard, ())
+        return (Guard, (str(self.expression), ))
 
-class Label(object):
-    _labels = dict()
-
-    def __init__(self, pda, value):
-        self._value = value
 
-        pda.attach_symbol(self)
+class Label(_Flyweight):
+    """A stack symbol. Labels are interned, so they compare by identity."""
+    __slots__ = ('value', )
+    _fields = __slots__
+    _instances = WeakValueDictionary()
+    _ids = count()
 
-    def __eq__(self, other):
-        try:
-            return self.value == other.value
-        except AttributeError:
-            return False
-
-    def __hash__(self):
-        return hash(self.value)
+    @classmethod
+    def get_label(cls, value):
+        return cls(value)
 
     def __str__(self):
         return str(self.value)
@@ -106,82 +180,139 @@ class Label(object):
     def __repr__(self):
         return f"<Label: {self.value!r}>"
 
-    @property
-    def value(self):
-        return self._value
-
     def visit(self, visitor, *args, **kwargs):
         return visitor.visit_label(self, *args, **kwargs)
 
 
-# @IMPROVEMENT: Maybe we should have some "graph" class that we pass into all
-# these objects.
-class Transition(object):
-    def __init__(self, pda, from_, to, inlabel, action, text=None,
-                 guard=Guard()):
-        self.from_ = from_
-        self.to = to
-
-        self.inlabel = inlabel
-        self.action = action
-
-        self.text = text
-        self.guard = guard
-
-        self.comments = []
+class _TransitionView(object):
+    # A transition is pending until attached, after which it is nothing but
+    # an index into the arrays of its PDA.
+    __slots__ = ('pda', 'id', '_pending')
 
+    def __init__(self, pda, from_, to, inlabel, action, text, guard):
         self.pda = pda
+        self.id = None
+        self._pending = [from_, to, inlabel, action, text, guard, []]
+
+    @classmethod
+    def _view(cls, pda, id_):
+        view = cls.__new__(cls)
+        view.pda = pda
+        view.id = id_
+        view._pending = None
+        return view
 
     def attach(self):
-        self.pda.attach_transition(self)
-        self.from_.attach_outgoing(self)
-        self.to.attach_incoming(self)
+        self.id = self.pda.attach_transition(*self._pending)
+        self._pending = None
         return self
 
     def add_comment(self, comment):
         self.comments.append(comment)
         return self
 
+    @property
+    def from_(self):
+        if self._pending is not None:
+            return self._pending[0]
+        return Location(self.pda, self.pda.sources[self.id])
+
+    @property
+    def to(self):
+        if self._pending is not None:
+            return self._pending[1]
+        return Location(self.pda, self.pda.targets[self.id])
+
+    @property
+    def action(self):
+        if self._pending is not None:
+            return self._pending[3]
+        return self.pda.actions[self.pda.action_ids[self.id]]
+
+    @property
+    def text(self):
+        if self._pending is not None:
+            return self._pending[4]
+        return self.pda.texts.get(self.id)
+
+    @property
+    def guard(self):
+        if self._pending is not None:
+            return self._pending[5]
+        return self.pda.guards[self.pda.guard_ids[self.id]]
+
+    @property
+    def comments(self):
+        if self._pending is not None:
+            return self._pending[6]
+        comments = self.pda.comments.get(self.id, ())
+        if not isinstance(comments, list):
+            # Stored interned as a tuple, copied once someone wants to add
+            comments = self.pda.comments[self.id] = list(comments)
+        return comments
+
+    def __eq__(self, other):
+        if self.id is None:
+            return self is other
+        return (isinstance(other, _TransitionView)
+                and self.pda is other.pda
+                and self.id == other.id)
+
+    def __hash__(self):
+        if self.id is None:
+            return id(self)
+        return hash((id(self.pda), self.id))
+
+
+class Transition(_TransitionView):
+    __slots__ = ()
+
+    def __init__(self, pda, from_, to, inlabel, action, text=None,
+                 guard=Guard()):
+        super().__init__(pda, from_, to, inlabel, action, text, guard)
+
+    @property
+    def inlabel(self):
+        if self._pending is not None:
+            return self._pending[2]
+        return self.pda.labels[self.pda.inlabels[self.id]]
+
     def visit(self, visitor, *args, **kwargs):
         return visitor.visit_transition(self, *args, **kwargs)
 
     def __repr__(self):
         return (
             f'{self.inlabel}{self.from_!r}{self.to!r}{self.action!r}'
-            f'<{id(self)}>'
+            f'<{self.id}>'
         )
 
 
-class StarTransition(object):
+class StarTransition(_TransitionView):
+    __slots__ = ()
+
     def __init__(self, pda, from_, to, action, text=None,
                  guard=Guard()):
-        self.from_ = from_
-        self.to = to
+        super().__init__(pda, from_, to, None, action, text, guard)
 
-        self.action = action
+    def visit(self, visitor, *args, **kwargs):
+        return visitor.visit_star_transition(self, *args, **kwargs)
 
-        self.text = text
-        self.guard = guard
+    def __repr__(self):
+        return f'(*){self.from_!r}{self.to!r}{self.action!r}{self.id}'
 
-        self.comments = []
 
-        self.pda = pda
+class _Views(object):
+    """Sized, iterable view over the numbered items of a PDA."""
 
-    def attach(self):
-        self.pda.attach_transition(self)
-        self.from_.attach_outgoing(self)
-        self.to.attach_incoming(self)
-        return self
+    def __init__(self, make, count):
+        self._make = make
+        self._count = count
 
-    def add_comment(self, comment):
-        self.comments.append(comment)
-        return self
-
-    def visit(self, visitor, *args, **kwargs):
-        return visitor.visit_star_transition(self, *args, **kwargs)
+    def __len__(self):
+        return self._count
 
-    def __repr__(self):
-        return f'(*){self.from_!r}{self.to!r}{self.action!r}{id(self)}'
+    def __iter__(self):
+        return map(self._make, range(self._count))
 
 
 class PDA(object):
@@ -189,14 +320,77 @@ class PDA(object):
         self.initial = None
         self.final = None
 
-        self.locations = set()
-        self.transitions = set()
-        self.symbols = set()
-
         self.specials = {}
 
+        # Indexed by location id
+        self.location_names = []
+        # The labels and actions used, by id. Holding on to them keeps their
+        # ids valid
+        self.labels = {}
+        self.actions = {}
+
+        # Indexed by transition id
+        self.sources = array('i')
+        self.targets = array('i')
+        self.inlabels = array('i')
+        self.action_ids = array('i')
+        self.guard_ids = array('i')
+        # Sparse, only few transitions have any. Comments are shared between
+        # transitions as tuples until they are changed
+        self.texts = {}
+        self.comments = {}
+        self._comment_index = {}
+
+        # Interned guards, the objects and their moped expression
+        self.guards = []
+        self.guard_table = []
+        self._guard_index = {}
+
+        # Adjacency, built on demand and caught up with the transitions added
+        # since. Passes that rewrite the arrays clear it.
+        self._adjacency = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_adjacency'] = {}
+        return state
+
+    def __setstate__(self, state):
+        # Label and action ids are only valid in the process that made them,
+        # so the arrays are renumbered to the ids they have here
+        self.__dict__.update(state)
+        labels = {STAR: STAR}
+        labels.update((id_, label.id) for id_, label in self.labels.items())
+        actions = {id_: action.id for id_, action in self.actions.items()}
+        self.inlabels = array('i', map(labels.__getitem__, self.inlabels))
+        self.action_ids = array('i', map(actions.__getitem__,
+                                         self.action_ids))
+        self.labels = {label.id: label for label in self.labels.values()}
+        self.actions = {action.id: action for action in self.actions.values()}
+
+    @property
+    def locations(self):
+        return _Views(self.location_view, len(self.location_names))
+
+    @property
+    def symbols(self):
+        return self.labels.values()
+
+    @property
+    def transitions(self):
+        return _Views(self.transition_view, len(self.sources))
+
+    def location_view(self, id_):
+        return Location(self, id_)
+
+    def transition_view(self, id_):
+        if self.inlabels[id_] == STAR:
+            return StarTransition._view(self, id_)
+        return Transition._view(self, id_)
+
     def location(self, name):
-        return Location(self, name)
+        self.location_names.append(name)
+        return Location(self, len(self.location_names) - 1)
 
     def start_location(self, location):
         assert(self.initial is None)
@@ -208,9 +402,6 @@ class PDA(object):
         self.final = location
         return location
 
-    def attach_location(self, transition):
-        self.locations.add(transition)
-
     def transition(self, from_, to, symbol, action, text=None, guard=Guard()):
         return Transition(self, from_, to, symbol, action, text, guard)
 
@@ -224,11 +415,139 @@ class PDA(object):
             guard
         )
 
-    def attach_transition(self, transition):
-        self.transitions.add(transition)
+    def attach_transition(self, from_, to, inlabel, action, text=None,
+                          guard=Guard(), comments=()):
+        id_ = len(self.sources)
+        self.sources.append(from_.id)
+        self.targets.append(to.id)
+        self.inlabels.append(STAR if inlabel is None else self.use(inlabel))
+        self.action_ids.append(self._action_id(action))
+        self.guard_ids.append(self._guard_id(guard))
+        if text is not None:
+            self.texts[id_] = text
+        if comments:
+            comments = tuple(comments)
+            self.comments[id_] = self._comment_index.setdefault(comments,
+                                                                comments)
+        return id_
 
     def symbol(self, value):
-        return Label(self, value)
-
-    def attach_symbol(self, symbol):
-        self.symbols.add(symbol)
+        label = Label(value)
+        self.use(label)
+        return label
+
+    def use(self, label):
+        """Add a label to the alphabet, returning its id."""
+        if label.id not in self.labels:
+            self.labels[label.id] = label
+        return label.id
+
+    def _action_id(self, action):
+        if action.id not in self.actions:
+            self.actions[action.id] = action
+            for label in action.operands():
+                self.use(label)
+        return action.id
+
+    def _guard_id(self, guard):
+        if guard.expression is None:
+            key = None
+        else:
+            key = f"({guard.expression})"
+        id_ = self._guard_index.get(key)
+        if id_ is None:
+            id_ = len(self.guards)
+            self.guards.append(guard)
+            self.guard_table.append(key)
+            self._guard_index[key] = id_
+        return id_
+
+    def merge(self, other, locate):
+        """Copy all transitions of `other` into this PDA.
+
+        `locate` maps the name of a location of `other` to the location of
+        this PDA it becomes, so locations can be shared by name. The arrays
+        are copied wholesale, only the location and guard ids are translated.
+        """
+        offset = len(self.sources)
+        locations = array('i', (locate(name).id
+                                for name in other.location_names))
+        guards = array('i', map(self._guard_id, other.guards))
+
+        self.sources.extend(map(locations.__getitem__, other.sources))
+        self.targets.extend(map(locations.__getitem__, other.targets))
+        self.inlabels.extend(other.inlabels)
+        self.action_ids.extend(other.action_ids)
+        self.guard_ids.extend(map(guards.__getitem__, other.guard_ids))
+        self.labels.update(other.labels)
+        self.actions.update(other.actions)
+
+        for id_, text in other.texts.items():
+            self.texts[offset + id_] = text
+        for id_, comments in other.comments.items():
+            comments = tuple(comments)
+            self.comments[offset + id_] = self._comment_index.setdefault(
+                comments, comments
+            )
+
+    def copy_transitions(self, other, ids, sources, targets):
+        """Copy the transitions `ids` of `other` between other locations.
+
+        `sources` and `targets` are the ids of the locations of this PDA the
+        copies go between. Labels, actions, guards and texts are kept,
+        comments are not.
+        """
+        offset = len(self.sources)
+        guards = {}
+        for id_ in ids:
+            inlabel = other.inlabels[id_]
+            if inlabel != STAR:
+                self.use(other.labels[inlabel])
+            self.inlabels.append(inlabel)
+            self.action_ids.append(
+                self._action_id(other.actions[other.action_ids[id_]])
+            )
+            guard = other.guard_ids[id_]
+            if guard not in guards:
+                guards[guard] = self._guard_id(other.guards[guard])
+            self.guard_ids.append(guards[guard])
+        self.sources.extend(sources)
+        self.targets.extend(targets)
+
+        for i, id_ in enumerate(ids):
+            text = other.texts.get(id_)
+            if text is not None:
+                self.texts[offset + i] = text
+
+    def outgoing(self, location_id):
+        """Ids of the transitions leaving a location."""
+        return self._index('sources')[location_id][:]
+
+    def outgoing_index(self):
+        """The offsets by location id into the ids of all transitions, sorted
+        by the location they leave, for passes over many locations."""
+        offsets = array('i', [0])
+        transitions = array('i')
+        for location in self._index('sources'):
+            transitions.extend(location)
+            offsets.append(len(transitions))
+        return offsets, transitions
+
+    def incoming(self, location_id):
+        """Ids of the transitions entering a location."""
+        return self._index('targets')[location_id][:]
+
+    def _index(self, column):
+        # By location id, the ids of the transitions with that location in
+        # `column`. Only the transitions and locations added since the last
+        # lookup are indexed, so lookups can be mixed with construction.
+        ends = getattr(self, column)
+        index, indexed = self._adjacency.get(column, ([], 0))
+        if indexed == len(ends) and len(index) == len(self.location_names):
+            return index
+        for _ in range(len(index), len(self.location_names)):
+            index.append(array('i'))
+        for transition in range(indexed, len(ends)):
+            index[ends[transition]].append(transition)
+        self._adjacency[column] = index, len(ends)
+        return index
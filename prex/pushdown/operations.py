@@ -1,38 +1,27 @@
 from . import graph
 
-from functools import singledispatch
+from array import array
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
-class ReplicateActionVisitor(object):
-    def __init__(self, pda, symbols):
-        self.pda = pda
-        self.symbols = symbols
-
-    def visit_noop(self, action):
-        return graph.NoopAction()
-
-    def visit_pop(self, action):
-        return graph.PopAction()
-
-    def visit_push(self, action):
-        label = self.symbols[action.label.value]
-        return graph.PushAction(label)
-
-    def visit_replace(self, action):
-        label = self.symbols[action.label.value]
-        return graph.ReplaceAction(label)
-
-    def visit_pushreplace(self, action):
-        label1 = self.symbols[action.label1.value]
-        label2 = self.symbols[action.label2.value]
-        return graph.PushReplaceAction(label1, label2)
+def _adopt(pda, other):
+    # Copy `other` into `pda` with a new location for each of its own, in the
+    # same order, returning the id the first of them gets
+    offset = len(pda.location_names)
+    pda.merge(other, pda.location)
+    return offset
 
 
 def concat_disjoint(p1, p2, destructive=False):
+    """Join the final location of `p1` to the initial one of `p2`.
+
+    The locations of both stay apart, even if they have the same name. With
+    `destructive` the larger of the two is reused and the other is copied
+    into it, array by array.
+    """
     skip1 = False
     skip2 = False
     if destructive:
@@ -48,90 +37,31 @@ def concat_disjoint(p1, p2, destructive=False):
     else:
         pda = graph.PDA()
 
-    symbols = {}
-    # Union the alphabets
-    logger.info(f"Transferring {len(p1.symbols)} symbols from P1")
-    for symbol in p1.symbols:
-        if skip1:
-            symbols[symbol.value] = symbol
-        else:
-            if symbol.value not in symbols:
-                symbols[symbol.value] = pda.symbol(symbol.value)
-
-    logger.info(f"Transferring {len(p2.symbols)} symbols from P2")
-    for symbol in p2.symbols:
-        if skip2:
-            symbols[symbol.value] = symbol
-        else:
-            if symbol.value not in symbols:
-                symbols[symbol.value] = pda.symbol(symbol.value)
-
     if not skip1:
-        for k, v in p1.specials.items():
-            pda.specials[k] = symbols[v.value]
+        pda.specials.update(p1.specials)
 
     if not skip2:
-        for k, v in p2.specials.items():
-            pda.specials[k] = symbols[v.value]
-
-    locations = {}
-    # Union locations, since we are computing the disjoint concat, we don't
-    # deduplicate based on value
-    logger.info(f"Transferring {len(p1.locations)} locations from P1")
-    for location in p1.locations:
-        if skip1:
-            locations[location] = location
-        else:
-            locations[location] = pda.location(location.name)
+        pda.specials.update(p2.specials)
 
-    logger.info(f"Transferring {len(p2.locations)} locations from P2")
-    for location in p2.locations:
-        if skip2:
-            locations[location] = location
-        else:
-            locations[location] = pda.location(location.name)
-
-    replicateVisitor = ReplicateActionVisitor(pda, symbols)
-
-    @singledispatch
-    def add_trans(transition, pda):
-        symbol = symbols[transition.inlabel.value]
-        action = transition.action.visit(replicateVisitor)
-        from_ = locations[transition.from_]
-        to = locations[transition.to]
-        pda.transition(
-            from_,
-            to,
-            symbol,
-            action,
-            transition.text,
-            transition.guard
-        ).attach()
-
-    @add_trans.register(graph.StarTransition)
-    def add_star(transition, pda):
-        action = transition.action.visit(replicateVisitor)
-        from_ = locations[transition.from_]
-        to = locations[transition.to]
-        pda.star_transition(
-            from_, to,
-            action,
-            transition.text,
-            transition.guard
-        ).attach()
-
-    if not skip1:
-        logger.info(f"Transferring {len(p1.transitions)} transitions from P1")
-        for transition in p1.transitions:
-            add_trans(transition, pda)
+    # Union the locations and transitions. Since we are computing the
+    # disjoint concat, we don't deduplicate based on value. Labels are
+    # shared between PDAs, so the alphabets are united by the merge
+    if skip1:
+        offset1 = 0
+    else:
+        logger.info(f"Transferring {len(p1.transitions)} transitions and"
+                    f" {len(p1.locations)} locations from P1")
+        offset1 = _adopt(pda, p1)
 
-    if not skip2:
-        logger.info(f"Transferring {len(p2.transitions)} transitions from P2")
-        for transition in p2.transitions:
-            add_trans(transition, pda)
+    if skip2:
+        offset2 = 0
+    else:
+        logger.info(f"Transferring {len(p2.transitions)} transitions and"
+                    f" {len(p2.locations)} locations from P2")
+        offset2 = _adopt(pda, p2)
 
-    p1_end = locations[p1.final]
-    p2_start = locations[p2.initial]
+    p1_end = pda.location_view(offset1 + p1.final.id)
+    p2_start = pda.location_view(offset2 + p2.initial.id)
 
     pda.star_transition(
         p1_end,
@@ -145,9 +75,124 @@ def concat_disjoint(p1, p2, destructive=False):
         p2.initial = None
 
     if not skip1:
-        pda.start_location(locations[p1.initial])
+        pda.start_location(pda.location_view(offset1 + p1.initial.id))
 
     if not skip2:
-        pda.end_location(locations[p2.final])
+        pda.end_location(pda.location_view(offset2 + p2.final.id))
+
+    return pda
 
+
+def _identity_guards(expgen):
+    # Guards that leave every variable as it is. Moped leaves variables not
+    # mentioned in an expression unconstrained, so without any variables
+    # every guard is one, otherwise only the one keeping all of them.
+    keep = f"({expgen.get_expression()})"
+    if not expgen.used:
+        return {None, keep}
+    if {var.name for var in expgen.keepvars} == set(expgen.used):
+        return {keep}
+    return set()
+
+
+def contract_noops(expgen, pda, trace_key=None):
+    """Merge locations joined by noop star transitions that change nothing.
+
+    Such a transition can always be taken and has no effect, so if it is the
+    only way into its target, the target's transitions can leave from its
+    source instead, and if it is the only way out of its source, the
+    transitions into the source can go to its target instead. The PDA is
+    changed in place.
+
+    Merged locations disappear from witness traces. With `trace_key`, a
+    function of a location name, a location is only merged into one with the
+    same key, unless its own key is None.
+    """
+    identity = _identity_guards(expgen)
+    noop = graph.NoopAction().id
+    if not identity or noop not in pda.actions:
+        return pda
+
+    sources = pda.sources
+    targets = pda.targets
+    location_count = len(pda.location_names)
+    out_degree = [0] * location_count
+    for source in sources:
+        out_degree[source] += 1
+    in_degree = [0] * location_count
+    for target in targets:
+        in_degree[target] += 1
+
+    representative = list(range(location_count))
+
+    def find(location):
+        root = location
+        while representative[root] != root:
+            root = representative[root]
+        while representative[location] != root:
+            representative[location], location = root, representative[location]
+        return root
+
+    def hideable(location, into):
+        if trace_key is None:
+            return True
+        key = trace_key(pda.location_names[location])
+        return key is None or key == trace_key(pda.location_names[into])
+
+    initial = pda.initial.id
+    final = pda.final.id
+    guard_table = pda.guard_table
+    removed = bytearray(len(sources))
+    for transition, (inlabel, action, guard) in enumerate(zip(
+            pda.inlabels, pda.action_ids, pda.guard_ids)):
+        if (inlabel != graph.STAR or action != noop
+                or guard_table[guard] not in identity):
+            continue
+        from_ = find(sources[transition])
+        to = find(targets[transition])
+        if from_ == to:
+            out_degree[from_] -= 1
+            in_degree[from_] -= 1
+        elif (in_degree[to] == 1 and to != initial
+              and hideable(to, from_)):
+            representative[to] = from_
+            out_degree[from_] += out_degree[to] - 1
+            if to == final:
+                final = from_
+        elif (out_degree[from_] == 1 and from_ != final
+              and hideable(from_, to)):
+            representative[from_] = to
+            in_degree[to] += in_degree[from_] - 1
+            if from_ == initial:
+                initial = to
+        else:
+            continue
+        removed[transition] = 1
+
+    kept = [transition for transition in range(len(sources))
+            if not removed[transition]]
+    logger.info(f"Contracted {len(sources) - len(kept)} noop transitions")
+    if len(kept) == len(sources):
+        return pda
+
+    locations = [find(location) for location in range(location_count)]
+    pda.sources = array('i', (locations[sources[transition]]
+                              for transition in kept))
+    pda.targets = array('i', (locations[targets[transition]]
+                              for transition in kept))
+    for column in ('inlabels', 'action_ids', 'guard_ids'):
+        values = getattr(pda, column)
+        setattr(pda, column, array('i', (values[transition]
+                                         for transition in kept)))
+    renumbered = {transition: id_ for id_, transition in enumerate(kept)}
+    pda.texts = {renumbered[transition]: text
+                 for transition, text in pda.texts.items()
+                 if transition in renumbered}
+    pda.comments = {renumbered[transition]: comments
+                    for transition, comments in pda.comments.items()
+                    if transition in renumbered}
+    pda._adjacency.clear()
+
+    pda.initial = pda.location_view(initial)
+    pda.final = pda.location_view(final)
     return pda
@@ -1,6 +1,7 @@
 import io
 import logging
 from . import model
+from ... import graph
 
 
 logger = logging.getLogger(__name__)
@@ -161,196 +162,108 @@ class PerfectPrintVisitor(object):
         )
 
 
-class MopedPrintVisitor(object):
-    def __init__(self, possible_tops):
-        self.star_stringifyer = StarTransitionVisitor()
-        self.possible_tops = possible_tops
+def coreachable(pda):
+    """Find the locations the final location can be reached from.
+
+    The stack is ignored, so this over-approximates. Returns a bytearray
+    indexed by location id.
+    """
+    live = bytearray(len(pda.location_names))
+    live[pda.final.id] = 1
+    sources = pda.sources
+    front = [pda.final.id]
+    while front:
+        location = front.pop()
+        for transition in pda.incoming(location):
+            source = sources[transition]
+            if not live[source]:
+                live[source] = 1
+                front.append(source)
+    return live
+
+
+def possible_tops(pda, start_label, live=None):
+    """Compute the symbols that can be on top of the stack in every location.
+
+    Returns a list of sets of label ids, indexed by location id. Locations
+    not marked in `live` are never entered, their sets stay empty.
+    """
+    tops = [set() for _ in range(len(pda.location_names))]
+    all_symbols = set(pda.labels)
+
+    sources = pda.sources
+    targets = pda.targets
+    inlabels = pda.inlabels
+    action_ids = pda.action_ids
+    action_table = _action_table(pda)
+
+    tops[pda.initial.id].add(start_label.id)
+    front = {pda.initial.id}
+    while front:
+        location = front.pop()
+        labels = tops[location]
+
+        for transition in pda.outgoing(location):
+            inlabel = inlabels[transition]
+            if inlabel == graph.STAR:
+                inlabels_ = labels
+            elif inlabel in labels:
+                inlabels_ = {inlabel}
+            else:
+                continue
+
+            kind, label1, _ = action_table[action_ids[transition]]
+            if kind == graph.POP:
+                added = all_symbols
+            elif kind == graph.NOOP:
+                added = inlabels_
+            else:
+                added = {label1}
+
+            to = targets[transition]
+            if live is not None and not live[to]:
+                continue
+            new = added - tops[to]
+            if new:
+                front.add(to)
+                tops[to].update(new)
+
+    return tops
+
+
+def _action_table(pda):
+    # Action id to (kind, label1, label2), with the labels as ids
+    table = {}
+    for id_, action in pda.actions.items():
+        label1, label2 = (tuple(label.id for label in action.operands())
+                          + (None, None))[:2]
+        table[id_] = (action.kind, label1, label2)
+    return table
+
+
+def _outlabels(kind, label1, label2, inlabel):
+    if kind == graph.POP:
+        return None, None
+    if kind == graph.PUSH:
+        return label1, inlabel
+    if kind == graph.NOOP:
+        return inlabel, None
+    if kind == graph.REPLACE:
+        return label1, None
+    if kind == graph.PUSHREPLACE:
+        return label1, label2
+    raise RuntimeError(f"Internal error: Unknown action kind in compiler:"
+                       f" {kind}")
+
+
+class TransitionIndex(object):
+    """Maps the text of a moped transition back to the pushdown transition."""
 
-    def specify_list(self, transitions, f, mapping, transition_mapping):
-        self.transition_mapping = transition_mapping
-        self.mapping = mapping
-        # Then we print!
-        size = 0
-        for transition in transitions:
-            size += transition.visit(self, f)
-
-        return size
-
-    def visit_location(self, location):
-        return self.mapping[location]
-
-    def visit_pop(self, action, inlabel=None):
-        return ()
-
-    def visit_push(self, action, inlabel=None):
-        return (
-            action.label.visit(self),
-            inlabel.visit(self)
-        )
-
-    def visit_noop(self, action, inlabel=None):
-        return (inlabel.visit(self), )
-
-    def visit_replace(self, action, inlabel=None):
-        return (action.label.visit(self), )
-
-    def visit_pushreplace(self, action, inlabel=None):
-        return (
-            action.label1.visit(self),
-            action.label2.visit(self),
-        )
-
-    def visit_guard(self, guard):
-        return (f"({guard.expression})"
-                if guard.expression is not None
-                else None)
-
-    def visit_label(self, label):
-        return self.mapping[label]
-
-    def visit_special_label(self, label):
-        return self.mapping[label]
-
-    def visit_transition(self, transition, f):
-        if transition.inlabel not in self.possible_tops[transition.from_]:
-            return 0
-        outlabels = transition.action.visit(self, inlabel=transition.inlabel)
-        if len(outlabels) == 0:
-            outlabel1 = None
-            outlabel2 = None
-        elif len(outlabels) == 1:
-            outlabel1 = outlabels[0]
-            outlabel2 = None
-        elif len(outlabels) == 2:
-            outlabel1 = outlabels[0]
-            outlabel2 = outlabels[1]
-        else:
-            raise RuntimeError(f"Internal error: Wrong numer of out"
-                               f"labels in compiler: {len(outlabels)}")
-
-        model.emit_comments(f, transition.comments)
-        model.emit_transition(
-            f,
-            transition.from_.visit(self),
-            transition.inlabel.visit(self),
-            transition.to.visit(self),
-            outlabel1, outlabel2,
-            self.transition_mapping[transition],
-            transition.guard.visit(self),
-        )
-        return 1
-
-    def visit_epsilon_transition(self, transition, f):
-        model.emit_comments(f, transition.comments)
-        eps = self.star_stringifyer.make_string(transition)
-        with model.emit_transition_group(f, eps):
-            from_str = transition.from_.visit(self)
-            to_str = transition.to.visit(self)
-            text_str = self.transition_mapping[transition]
-            guard_str = transition.guard.visit(self)
-
-            for inlabel in transition.in_label_domain:
-                inlabel_str = inlabel.visit(self)
-
-                outlabels = transition.action.visit(self, inlabel=inlabel)
-                if len(outlabels) == 0:
-                    outlabel1 = None
-                    outlabel2 = None
-                elif len(outlabels) == 1:
-                    outlabel1 = outlabels[0]
-                    outlabel2 = None
-                elif len(outlabels) == 2:
-                    outlabel1 = outlabels[0]
-                    outlabel2 = outlabels[1]
-                else:
-                    raise RuntimeError(f"Internal error: Wrong numer of out"
-                                       f"labels in compiler: {len(outlabels)}")
-
-                model.emit_transition(
-                    f,
-                    from_str,
-                    inlabel_str,
-                    to_str,
-                    outlabel1,
-                    outlabel2,
-                    text_str,
-                    guard_str,
-                )
-        return len(transition.in_label_domain)
-
-    def visit_star_transition(self, transition, f):
-        model.emit_comments(f, transition.comments)
-        eps = self.star_stringifyer.make_string(transition)
-        with model.emit_transition_group(f, eps):
-            from_str = transition.from_.visit(self)
-            to_str = transition.to.visit(self)
-            text_str = self.transition_mapping[transition]
-            guard_str = transition.guard.visit(self)
-
-            for inlabel in self.possible_tops[transition.from_]:
-                inlabel_str = inlabel.visit(self)
-
-                outlabels = transition.action.visit(self, inlabel=inlabel)
-                if len(outlabels) == 0:
-                    outlabel1 = None
-                    outlabel2 = None
-                elif len(outlabels) == 1:
-                    outlabel1 = outlabels[0]
-                    outlabel2 = None
-                elif len(outlabels) == 2:
-                    outlabel1 = outlabels[0]
-                    outlabel2 = outlabels[1]
-                else:
-                    raise RuntimeError(f"Internal error: Wrong numer of out"
-                                       f"labels in compiler: {len(outlabels)}")
-
-                model.emit_transition(
-                    f,
-                    from_str,
-                    inlabel_str,
-                    to_str,
-                    outlabel1,
-                    outlabel2,
-                    text_str,
-                    guard_str,
-                )
-        return len(self.possible_tops[transition.from_])
-
-
-class TopResolver(object):
     def __init__(self, pda):
         self.pda = pda
 
-    def visit_push(self, action, inlabel=None):
-        return {action.label}
-
-    def visit_replace(self, action, inlabel=None):
-        return {action.label}
-
-    def visit_pushreplace(self, action, inlabel=None):
-        return {action.label1}
-
-    def visit_pop(self, action, inlabel=None):
-        return self.pda.symbols
-
-    def visit_noop(self, action, inlabel=None):
-        return inlabel
-
-    def visit_transition(self, transition, labels):
-        if transition.inlabel not in labels:
-            return set()
-        return transition.action.visit(self, inlabel={transition.inlabel})
-
-    def visit_epsilon_transition(self, transition, labels):
-        if labels & transition.in_label_domain == set():
-            return set()
-        return transition.action.visit(
-            self,
-            inlabel=labels & transition.in_label_domain,
-        )
-
-    def visit_star_transition(self, transition, labels):
-        return transition.action.visit(self, labels)
+    def __getitem__(self, text):
+        return self.pda.transition_view(int(text))
 
 
 def compile(expgen, pda, start_label, end_label, emit_comments=True):
@@ -358,42 +271,24 @@ def compile(expgen, pda, start_label, end_label, emit_comments=True):
     # @CLEANUP: Hoist this to somewhere more appropriate, I'm thinking in the
     # general pushdown operations, since it's pretty generic -Jesper 19/06-2018
     logger.info("Calculating the possible tops of stack")
-    T = {}
-    Tfront = {
-        pda.initial
-    }
-
-    resolver = TopResolver(pda)
-    for location in pda.locations:
-        T[location] = set()
-    T[pda.initial].add(start_label)
-    while Tfront:
-        location = Tfront.pop()
-
-        for transition in location._outgoing:
-            addedTops = transition.visit(resolver, T[location])
-            newTops = addedTops - T[transition.to]
-            if newTops:
-                Tfront.add(transition.to)
-                T[transition.to].update(newTops)
+    # Locations that can't be reached, or can't reach the final location, are
+    # left out. Unreachable ones have no tops, so only the latter need to be
+    # checked again when emitting.
+    live = coreachable(pda)
+    T = possible_tops(pda, start_label, live)
 
     # f = open("pds.pds", "wt")
     f = io.StringIO()
 
-    # First we mangle!
+    # First we mangle! Transitions are named by their id, symbols and
+    # locations are numbered after them
     logger.info("Assigning new names")
-    mapping = {}
-    transition_mapping = {}
-    count = 0
-    for transition in pda.transitions:
-        transition_mapping[transition] = str(count)
-        count += 1
-    for symbol in pda.symbols:
-        mapping[symbol] = f"_{count}"
-        count += 1
-    for location in pda.locations:
-        mapping[location] = f"_{count}"
-        count += 1
+    transition_count = len(pda.sources)
+    symbol_count = len(pda.labels)
+    symbol_names = {label: f"_{transition_count + index}"
+                    for index, label in enumerate(pda.labels)}
+    location_names = [f"_{transition_count + symbol_count + location}"
+                      for location in range(len(pda.location_names))]
 
     # Then we dangle (make it pretty)!
     if emit_comments:
@@ -401,26 +296,77 @@ def compile(expgen, pda, start_label, end_label, emit_comments=True):
         perfect_printer = PerfectPrintVisitor()
         perfect_printer.specify_list(pda.transitions)
 
-    variables = ",".join(["var_0 (4)"])
+    variables = ", ".join(f"{name}({bits})"
+                          for name, bits in sorted(expgen.used.items()))
     model.emit_system_start(
         f,
         variables,
-        mapping[pda.initial],
-        mapping[pda.final],
-        mapping[start_label],
-        mapping[end_label],
+        location_names[pda.initial.id],
+        location_names[pda.final.id],
+        symbol_names[start_label.id],
+        symbol_names[end_label.id],
     )
-    compiler = MopedPrintVisitor(T)
 
     logger.info("Emitting transitions")
-    size = compiler.specify_list(
-        pda.transitions,
-        f,
-        mapping,
-        transition_mapping,
-    )
+    star_stringifyer = StarTransitionVisitor()
+    comments = pda.comments
+    guard_table = pda.guard_table
+    action_table = _action_table(pda)
+    size = 0
+    emitted = 0
+    for transition, (from_, to, inlabel, action, guard) in enumerate(zip(
+            pda.sources, pda.targets, pda.inlabels, pda.action_ids,
+            pda.guard_ids)):
+        if not live[to]:
+            continue
+        if inlabel == graph.STAR:
+            inlabels = sorted(T[from_])
+        elif inlabel in T[from_]:
+            inlabels = (inlabel, )
+        else:
+            continue
+
+        if transition in comments:
+            model.emit_comments(f, comments[transition])
+        if emit_comments and inlabel == graph.STAR:
+            model.emit_transition_group_start(f, star_stringifyer.make_string(
+                pda.transition_view(transition)
+            ))
+
+        from_str = location_names[from_]
+        to_str = location_names[to]
+        text_str = str(transition)
+        guard_str = guard_table[guard]
+        kind, label1, label2 = action_table[action]
+        for top in inlabels:
+            outlabel1, outlabel2 = _outlabels(kind, label1, label2, top)
+            model.emit_transition(
+                f,
+                from_str,
+                symbol_names[top],
+                to_str,
+                None if outlabel1 is None else symbol_names[outlabel1],
+                None if outlabel2 is None else symbol_names[outlabel2],
+                text_str,
+                guard_str,
+            )
+        size += len(inlabels)
+        emitted += bool(inlabels)
+
+        if emit_comments and inlabel == graph.STAR:
+            model.emit_transition_group_end(f)
 
     # f.close()
 
-    return model.System(f, size, pda.final, end_label, mapping,
-                        transition_mapping)
+    logger.info(
+        f"Trimmed {len(T) - sum(map(bool, T))} of {len(T)} locations and"
+        f" {transition_count - emitted} of {transition_count} transitions"
+    )
+
+    return model.System(
+        f,
+        size,
+        location_names[pda.final.id],
+        symbol_names[end_label.id],
+        TransitionIndex(pda),
+    )
@@ -23,7 +23,8 @@ def emit_transition_group(f, title, header=None):
 
 
 def emit_system_start(f, variables, initial, final, start_label, end_label):
-    #f.write(f"global int {variables};\n")
+    if variables:
+        f.write(f"global int {variables};\n")
     f.write("(")
     f.write(initial)
     f.write("<")
@@ -70,11 +71,11 @@ def emit_transition(f, from_, inlabel, to, outlabel1=None, outlabel2=None,
 
 
 class System(object):
-    def __init__(self, f, size, final, final_label, mapping,
-                 transition_mapping):
+    def __init__(self, f, size, final, final_label, transition_index):
         self.str = f.getvalue()
         self.size = size
+        # Moped names of the final location and label
         self.final = final
         self.final_label = final_label
-        self.mapping = mapping
-        self.transition_mapping = transition_mapping
+        # Maps transition texts back to pushdown transitions
+        self.transition_index = transition_index
@@ -16,11 +16,9 @@ def read_trace(trace):
 
 
 def map_trace(trace, transition_index):
-    # Mapping is transition: transition_text
-    # Invert because we have to go back!
-    reverse_mapping = {value: key for key, value in transition_index.items()}
+    # Index is transition_text: transition
     transition_texts = read_trace(trace)
-    transitions = [reverse_mapping[text] for text in transition_texts]
+    transitions = [transition_index[text] for text in transition_texts]
 
     return transitions
 
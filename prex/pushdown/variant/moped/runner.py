@@ -11,9 +11,7 @@ from .output_parser import (
 def query_system(system):
     fd_r, fd_w = os.pipe()
     os_path = f"/dev/fd/{fd_r}"
-    final_label_str = system.mapping[system.final_label]
-    final_location_str = system.mapping[system.final]
-    query = f"{final_location_str}:{final_label_str}"
+    query = f"{system.final}:{system.final_label}"
     with (Popen(
             ["moped", os_path, "-s0", "-tr", query],
             stdout=PIPE,
@@ -28,7 +26,7 @@ def query_system(system):
     # Need to close the pipe file descriptors
     os.close(fd_r)
 
-    result, transitions = parse_output(lines, system.transition_mapping)
+    result, transitions = parse_output(lines, system.transition_index)
 
     return result, transitions
 
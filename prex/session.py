@@ -0,0 +1,366 @@
+"""In-process API for building and checking networks.
+
+A `Session` holds the state of one network and the pushdown system compiled
+from it, so a single interpreter can check several networks and queries one
+after another, or from several sessions side by side::
+
+    with Session() as session:
+        session.load_xml('topo.xml', 'routing.xml')
+        session.compile('<.*> s1 .* s7 <>', 2)
+        result = session.verify()
+        if result:
+            for transition in result.transitions:
+                ...
+
+All state lives on the session. `release` (or leaving the `with` block) drops
+it again, after which the session can be loaded anew.
+
+The session keeps the pushdown fragment of every router between compilations,
+also of networks loaded before, and if asked for in the network cache
+directory for later runs. Compiling a changed network, whether changed in
+place or loaded again from a new snapshot, only rebuilds the fragments of the
+routers affected.
+"""
+import logging
+
+from prex import middleware
+from prex.middleware import (
+    fragments,
+    labelflow,
+    optimized_nfa_to_pda,
+    query_to_nfa,
+)
+from prex.middleware.slicing import slice_query
+from prex.mpls.juniper.xml import (
+    juniper,
+    model as juniper_model,
+)
+from prex.mpls.nester import Nester
+from prex.nfa import operations as nfa_operations
+from prex.prnml import (
+    cache as network_cache,
+    xml as prnml_xml,
+)
+from prex.pushdown import (
+    expression,
+    operations,
+)
+from prex.pushdown.variant import moped
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionError(RuntimeError):
+    pass
+
+
+def load_cached(kind, paths, load, cache=True, refresh_cache=False,
+                cache_dir=None):
+    """Call `load`, going through the network cache if `cache` is set."""
+    if not cache:
+        return load()
+
+    network_store = network_cache.NetworkCache(cache_dir)
+    key = network_cache.input_digest(kind, paths)
+    network = None if refresh_cache else network_store.load(key)
+    if network is None:
+        network = load()
+        network_store.store(key, network)
+    return network
+
+
+def read_juniper(isis_dir, forwarding_dir, ip_router_maps=(), jobs=1,
+                 stream=False):
+    ip_router_map = {}
+    for path in ip_router_maps:
+        ip_router_map.update(juniper.parse_router_ips(path))
+    topology = juniper.parse_isis(isis_dir, jobs=jobs)
+    parser = juniper.ForwardingParser(topology, ip_dns_map=ip_router_map)
+    juniper_network = parser.parse_forwarding(
+        forwarding_dir,
+        jobs=jobs,
+        streaming=stream,
+    )
+    return juniper_model.PRNMLConverter(juniper_network).convert()
+
+
+def router_in(name):
+    """The router and interface a location of the composed pushdown is at.
+
+    None for the locations outside of the network.
+    """
+    if isinstance(name, tuple) and isinstance(name[0].name, tuple):
+        return tuple(name[0].name[0:2])
+    return None
+
+
+def is_acyclic(transitions):
+    """Check that a witness trace never visits a router twice."""
+    routers = set()
+    previous_router_in = None
+    for transition in transitions:
+        current = router_in(transition.to.name)
+        # Filter out internal transitions going to internal locations
+        if current is None:
+            continue
+        if current == previous_router_in:
+            # Need to allow traversing action chains
+            continue
+        if current[0] in routers:
+            # Found a repeated router, trace is cyclic
+            return False
+        previous_router_in = current
+        routers.add(current[0])
+    return True
+
+
+class Result(object):
+    """Outcome of `Session.verify`, truthy if the query is satisfied."""
+
+    def __init__(self, satisfied, transitions):
+        self.satisfied = satisfied
+        # The witness trace, only meaningful if satisfied
+        self.transitions = transitions
+
+    def __bool__(self):
+        return self.satisfied
+
+    def __repr__(self):
+        return f'<Result {"YES" if self.satisfied else "NO"}>'
+
+
+class Session(object):
+    def __init__(self):
+        self.network = None
+        self.system = None
+        self.under = False
+        # dict: NFA -> ((locations, transitions) before, and after simplifying)
+        self.nfa_sizes = {}
+        self.fragments = fragments.FragmentCache()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def load(self, network):
+        """Use an already loaded prnml network.
+
+        Router fragments are kept, they are reused for the routers that are
+        the same in the new network.
+        """
+        self.network = network
+        self.system = None
+        self.under = False
+        self.nfa_sizes = {}
+        return network
+
+    def _store_fragments(self, cache_options):
+        # Fragments are only written next to the cached networks when asked
+        # for, as nothing ever removes them again
+        cache_fragments = cache_options.pop('cache_fragments', False)
+        self.fragments.store = (
+            network_cache.NetworkCache(cache_options.get('cache_dir'))
+            if cache_options['cache'] and cache_fragments else None
+        )
+
+    def load_xml(self, topology, routing, **cache_options):
+        """Load a network in the prnml XML format.
+
+        `cache_options` are passed on to `load_cached`, the cache is off by
+        default. With the cache and `cache_fragments` on, router fragments are
+        kept in its directory as well.
+        """
+        cache_options.setdefault('cache', False)
+        self._store_fragments(cache_options)
+        return self.load(load_cached(
+            'xml',
+            (topology, routing),
+            lambda: prnml_xml.read_network(topology, routing),
+            **cache_options
+        ))
+
+    def load_juniper(self, isis_dir, forwarding_dir, ip_router_maps=(),
+                     jobs=1, stream=False, **cache_options):
+        """Load a network from Juniper ISIS and forwarding table dumps."""
+        cache_options.setdefault('cache', False)
+        self._store_fragments(cache_options)
+        return self.load(load_cached(
+            'juniper-xml',
+            (isis_dir, forwarding_dir, *ip_router_maps),
+            lambda: read_juniper(isis_dir, forwarding_dir, ip_router_maps,
+                                 jobs, stream),
+            **cache_options
+        ))
+
+    def load_nested(self, topology, routing, nesting_level):
+        """Load a prnml network nested into itself `nesting_level` times."""
+        return self.load(Nester(topology, routing).nest(nesting_level))
+
+    def compile(self, query, max_failed_links, under=False, verbose=False,
+                slicing=True, jobs=1):
+        """Compile the loaded network and a query into a moped system.
+
+        `query` is either the query itself or a `pathlib.Path` to a file
+        holding it. With `under` the network is under-approximated instead of
+        over-approximated. With `slicing` only the routers the query can read
+        are simulated. The fragments of the routers and the product with the
+        query are built by `jobs` processes, 0 for one per core.
+        """
+        if self.network is None:
+            raise SessionError('No network loaded')
+        network = self.network
+        k = max_failed_links
+
+        # Drop the previous system before building the next one
+        self.system = None
+        self.under = under
+        self.nfa_sizes = {}
+
+        expgen = expression.Generator()
+
+        logger.info(
+            f"Processing {len(network.routing._routingTables)} routing"
+            f" tables with a total of {network.routing.count_rules()} rules"
+        )
+
+        logger.info(f"Constructing the header NFA")
+        query_ast = query_to_nfa.read_query(query)
+        label_domain = network.routing.collect_labels()
+        name_label_map = query_to_nfa.label_map(label_domain)
+        nfa_c = self._simplify(
+            'header',
+            query_to_nfa.parse_constructing(query_ast, name_label_map),
+            'C',
+        )
+        # Only labels that can occur with the query's headers are simulated
+        header = labelflow.header_labels(nfa_c)
+        if slicing:
+            slice_ = slice_query(query_ast, network.topology)
+            logger.info(f"Slicing the network to {slice_}")
+        else:
+            slice_ = None
+
+        logger.info("Constructing mpls simulation")
+        if under:
+            mpls_fragment = middleware.underapprox.to_pushdown(
+                expgen,
+                network,
+                k=k,
+                header=header,
+                slice_=slice_,
+                cache=self.fragments,
+                jobs=jobs,
+            )
+        else:
+            mpls_fragment = middleware.outonly.to_pushdown(
+                expgen,
+                network,
+                k=k,
+                header=header,
+                slice_=slice_,
+                cache=self.fragments,
+                jobs=jobs,
+            )
+
+        logger.info(f"Constructing NFAs")
+        nfa_n = self._simplify(
+            'path',
+            query_to_nfa.parse_network(
+                query_ast,
+                mpls_fragment,
+                network.topology.routers,
+            ),
+            'N',
+        )
+        nfa_d = self._simplify(
+            'final header',
+            query_to_nfa.parse_destructing(query_ast, name_label_map),
+            'D',
+        )
+        logger.info(f"Constructing builder")
+        constructor = optimized_nfa_to_pda.ConstructingPDA(expgen, nfa_c)
+        build_fragment = constructor.convert()
+        logger.info(f"Constructing destroyer")
+        destructor = optimized_nfa_to_pda.DestructingPDA(expgen, nfa_d)
+        destroy_fragment = destructor.convert()
+
+        logger.info(
+            f"Constructing APDA from NFA ({len(nfa_n.transitions)}) and PDA"
+            f" ({len(mpls_fragment.transitions)})"
+        )
+        apda_fragment = middleware.apda.compose(
+            expgen,
+            mpls_fragment,
+            nfa_n,
+            jobs=jobs,
+        )
+
+        logger.info(
+            f"Concating the builder ({len(build_fragment.transitions)})"
+            f" with the apda ({len(apda_fragment.transitions)})"
+        )
+        with_builder = operations.concat_disjoint(
+            build_fragment,
+            apda_fragment,
+            destructive=True
+        )
+
+        logger.info(f"Concating the destroyer"
+                    f" ({len(destroy_fragment.transitions)}) with the"
+                    f" builder-apda ({len(with_builder.transitions)})")
+        with_destroy = operations.concat_disjoint(
+            with_builder,
+            destroy_fragment,
+            destructive=True
+        )
+
+        logger.info("Contracting noop transitions")
+        operations.contract_noops(expgen, with_destroy, trace_key=router_in)
+
+        logger.info(f"Compiling pushdown with {len(with_destroy.transitions)}"
+                    f" symbolic transitions")
+        self.system = moped.compiler.compile(
+            expgen,
+            with_destroy,
+            with_destroy.specials["start"],
+            with_destroy.specials["end"],
+            bool(verbose),
+        )
+        return self.system
+
+    def _simplify(self, name, nfa, prefix):
+        simple = nfa_operations.simplify(nfa, prefix)
+        self.nfa_sizes[name] = (
+            (len(nfa.locations), len(nfa.transitions)),
+            (len(simple.locations), len(simple.transitions)),
+        )
+        return simple
+
+    def verify(self, cycle_detection=True):
+        """Run moped on the compiled system.
+
+        Witnesses of the under-approximation have to be acyclic, with
+        `cycle_detection` cyclic ones are rejected.
+        """
+        if self.system is None:
+            raise SessionError('No system compiled')
+        moped_result, transitions = moped.runner.query_system(self.system)
+
+        # If we're running the under approximation
+        # we need to ensure the witness is acyclic
+        if cycle_detection and self.under and moped_result:
+            satisfied = is_acyclic(transitions)
+        else:
+            satisfied = moped_result
+        return Result(satisfied, transitions)
+
+    def release(self):
+        """Drop everything the session holds, router fragments included."""
+        self.network = None
+        self.system = None
+        self.under = False
+        self.nfa_sizes = {}
+        self.fragments.clear()
@@ -3,3 +3,18 @@
 _title "Juniper"
 
 _exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py juniper-xml mini_dump/isis mini_dump/forwarding/ adv-query "<.*> Uranus .* Hypnos <.*>" 0 compile run
+_exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py juniper-xml -j 2 mini_dump/isis mini_dump/forwarding/ adv-query "<.*> Uranus .* Hypnos <.*>" 0 compile run
+_exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py juniper-xml --stream mini_dump/isis mini_dump/forwarding/ adv-query "<.*> Uranus .* Hypnos <.*>" 0 compile run
+_exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py juniper-xml mini_dump/isis mini_dump/forwarding/ adv-query "<.*> Uranus .* Hypnos <.*>" 0 compile -j 2 run
+
+_title "Dumping the network"
+
+# Label rules are dumped with a wildcard ingress interface
+dump=$(mktemp -d)
+_exec 2 "Loading" python3 $PROJECT_ROOT/prex/main.py juniper-xml mini_dump/isis mini_dump/forwarding/ dump-network $dump/topo.xml $dump/routing.xml
+_exec "from=\"*\"" grep -m 1 -o "from=\"\*\"" $dump/routing.xml
+_exec 2 "Loading" python3 $PROJECT_ROOT/prex/main.py juniper-xml mini_dump/isis mini_dump/forwarding/ dump-network --compact $dump/compact_topo.xml $dump/compact_routing.xml
+_exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py xml $dump/compact_topo.xml $dump/compact_routing.xml adv-query "<.*> Uranus .* Hypnos <.*>" 0 compile run
+_exec 2 "Loading" python3 $PROJECT_ROOT/prex/main.py xml $dump/compact_topo.xml $dump/compact_routing.xml dump-network $dump/again_topo.xml $dump/again_routing.xml
+_exec "" diff $dump/routing.xml $dump/again_routing.xml
+rm -r $dump
@@ -12,8 +12,48 @@ _exec 2 "NO" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-que
 _exec 2 "NO" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<> s3 .* s7 <>" 2 compile run
 
 _exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<.*> s2 .* s7 <>" 2 compile run
+
+# The sizes of the query NFAs are shown with the compile statistics
+_exec 2 "NFA path: 6 locations, 48 transitions simplified to 5 and 45" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile run
 _exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<.*> s2 .* s7 <.+>" 2 compile run
 
 _exec 2 "NO" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<> s1 .* s6 .* s9 .* s7 <>" 2 compile run
 _exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<> s1 .* s6 .* s7 <>" 2 compile run
 _exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<> s1 .* s9 .* s7 <>" 2 compile run
+
+_title "Network cache"
+
+_exec 3 "YES" python3 $PROJECT_ROOT/prex/main.py xml --no-cache topo.xml routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile run
+_exec 3 "YES" python3 $PROJECT_ROOT/prex/main.py xml --refresh-cache topo.xml routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile run
+_exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile run
+cache=$(mktemp -d)
+# The second run builds from the router fragments stored by the first
+_exec 5 "YES" python3 $PROJECT_ROOT/prex/main.py xml --cache-dir $cache --cache-fragments topo.xml routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile run
+_exec 5 "YES" python3 $PROJECT_ROOT/prex/main.py xml --cache-dir $cache --cache-fragments topo.xml routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile run
+_exec ".fragment" ls $cache
+# Without the flag only the network is cached
+rm -rf $cache
+_exec 4 "YES" python3 $PROJECT_ROOT/prex/main.py xml --cache-dir $cache topo.xml routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile run
+_exec "" test -z "$(find $cache -name '*.fragment')"
+rm -rf $cache
+# A cache that can't be written is skipped
+_exec 4 "YES" python3 $PROJECT_ROOT/prex/main.py xml --cache-dir topo.xml/cache topo.xml routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile run
+
+_title "Network slicing"
+
+_exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile --no-slice run
+_exec 2 "NO" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml adv-query "<> s1 .* s6 .* s9 .* s7 <>" 2 compile --no-slice run
+
+_title "Dumping the network"
+
+dump=$(mktemp -d)
+# Pretty output is kept byte for byte as it has always been written
+_exec 2 "Loading" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml dump-network --pretty $dump/pretty_topo.xml $dump/pretty_routing.xml
+_exec "" diff expected_topo.xml $dump/pretty_topo.xml
+_exec "" diff expected_routing.xml $dump/pretty_routing.xml
+_exec 2 "Loading" python3 $PROJECT_ROOT/prex/main.py xml topo.xml routing.xml dump-network --compact $dump/topo.xml $dump/routing.xml
+_exec 2 "YES" python3 $PROJECT_ROOT/prex/main.py xml $dump/topo.xml $dump/routing.xml adv-query "<.*> s1 .* s7 <>" 2 compile run
+# Links are written with their sides swapped, but the routing stays the same
+_exec 2 "Loading" python3 $PROJECT_ROOT/prex/main.py xml $dump/topo.xml $dump/routing.xml dump-network $dump/again_topo.xml $dump/again_routing.xml
+_exec "" diff expected_routing.xml $dump/again_routing.xml
+rm -r $dump
@@ -0,0 +1,23 @@
+# An NFA with an epsilon transition out of its initial location is composed
+# as it is, without simplifying it first
+from prex.middleware import apda
+from prex.nfa import graph as nfagraph
+from prex.pushdown import expression, graph
+
+pda = graph.PDA()
+a = pda.location('a')
+b = pda.location('b')
+pda.start_location(a)
+pda.end_location(b)
+pda.star_transition(a, b, graph.NoopAction()).attach()
+
+nfa = nfagraph.NFA()
+i = nfa.start_location('i')
+m = nfa.location('m')
+f = nfa.end_location('f')
+nfa.epsilon_transition(i, m).attach()
+nfa.transition(i, m, nfa.symbol(a)).attach()
+nfa.transition(m, f, nfa.symbol(b)).attach()
+
+product = apda.compose(expression.Generator(), pda, nfa)
+print(f'Composed {len(product.transitions)} transitions')
@@ -0,0 +1,29 @@
+# Two networks checked side by side in one process, each step of one session
+# followed by the same step of the other
+from prex.session import Session
+
+# By network, the queries asked in turn and their answers
+checks = {
+    '../1': [('<.*> s1 .* s7 <>', 2, True),
+             ('<> s1 .* s6 .* s9 .* s7 <>', 2, False)],
+    '../7': [('<> s1 .* s3 <>', 1, True),
+             ('<> s1 .* s3 <>', 0, False)],
+}
+
+sessions = {network: Session() for network in checks}
+for network, session in sessions.items():
+    session.load_xml(f'{network}/topo.xml', f'{network}/routing.xml')
+
+wrong = []
+for round_ in range(2):
+    for network, session in sessions.items():
+        query, k, _ = checks[network][round_]
+        session.compile(query, k)
+    for network, session in sessions.items():
+        query, k, expected = checks[network][round_]
+        if bool(session.verify()) != expected:
+            wrong.append((network, query, k))
+
+for session in sessions.values():
+    session.release()
+print(f'Wrong answers: {wrong}' if wrong else 'All answers right')
@@ -0,0 +1,7 @@
+#!/bin/bash -e
+
+_title "Composing with an epsilon out of the initial NFA location"
+_exec "Composed 2 transitions" python3 compose_epsilon.py
+
+_title "Sessions side by side"
+_exec "All answers right" python3 sessions.py